@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+Retry backoff shared by the Scrapy middleware and the asyncio crawler.
+"""
+import random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+
+def backoff_delay(attempt, base, maximum, retry_after=None):
+    """Exponential backoff with equal jitter, never shorter than the server's Retry-After."""
+    ceiling = min(maximum, base * 2 ** (attempt - 1))
+    delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, maximum))
+    return delay
+
+
+def retry_after_seconds(value):
+    """Seconds to wait from a Retry-After header value (seconds or an HTTP date), or None."""
+    if not value:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode('latin-1')
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
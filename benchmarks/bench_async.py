@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Cold-start benchmark of the asyncio crawler against the Scrapy spider.
+
+Runs ``python powerbi_async.py`` and ``scrapy runspider moj_spider.py`` as
+fresh processes against the local replay server, the way a scheduled delta
+run would start, and reports the time from process start to the first
+transaction row and to exit (medians over ``--runs``), plus whether both
+emitted the same rows.
+
+    python -m benchmarks.bench_async [--days-crawled 3] [--runs 5] [--json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+from benchmarks.replay_server import ReplayServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def timed_run(command, env):
+    """Run ``command``; seconds to its first stdout line and to exit, and the lines it printed."""
+    started = time.perf_counter()
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    first_row = None
+    lines = []
+    for line in process.stdout:
+        if first_row is None:
+            first_row = time.perf_counter() - started
+        lines.append(line)
+    process.wait()
+    return first_row, time.perf_counter() - started, lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=30, help='days of synthetic data on the server')
+    parser.add_argument('--rows-per-day', type=int, default=200)
+    parser.add_argument('--days-crawled', type=int, default=3, help='size of the crawled range, like a delta run')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    start_date = (date.today() - timedelta(days=args.days_crawled - 1)).isoformat()
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    state_path = os.path.join(tempfile.gettempdir(), 'moj_bench_async_state.sqlite')
+    report = {}
+    outputs = {}
+    with ReplayServer(days=args.days, rows_per_day=args.rows_per_day, latency=args.latency) as server:
+        crawl_args = [f'report_url={server.url}', f'start_date={start_date}', f'state_path={state_path}']
+        commands = {
+            'asyncio': [sys.executable, 'powerbi_async.py', '--log-level', 'ERROR', '--delay', '0']
+            + [arg for value in crawl_args for arg in ('-a', value)],
+            'scrapy': [sys.executable, '-m', 'scrapy', 'runspider', 'moj_spider.py', '-o', '-:jsonlines',
+                       '-s', 'LOG_LEVEL=ERROR', '-s', 'DOWNLOAD_DELAY=0', '-s', 'TELNETCONSOLE_ENABLED=False']
+            + [arg for value in crawl_args for arg in ('-a', value)],
+        }
+        for name, command in commands.items():
+            first_rows, totals = [], []
+            for _ in range(args.runs):
+                first_row, total, lines = timed_run(command, env)
+                first_rows.append(first_row or total)
+                totals.append(total)
+            outputs[name] = {json.dumps(json.loads(line), sort_keys=True) for line in lines}
+            report[name] = {
+                'first_row_s': round(statistics.median(first_rows), 3),
+                'total_s': round(statistics.median(totals), 3),
+                'rows': len(lines),
+            }
+
+    report['same_rows'] = outputs['asyncio'] == outputs['scrapy']
+    report['speedup_total'] = round(report['scrapy']['total_s'] / report['asyncio']['total_s'], 2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for key, value in report.items():
+        print(f'{key:<14} {value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end throughput benchmark: runs MojSpider against the local replay
+server and reports pages/sec, rows/sec, p50/p99 parse time and peak RSS.
+
+    python -m benchmarks.bench_spider [--fail-429 0.02] [--captcha 0.01] [--json]
+
+Every MojSpider argument can be passed through with ``-a name=value``.
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import tempfile
+import time
+
+from scrapy.crawler import CrawlerProcess
+
+from benchmarks.replay_server import ReplayServer
+from moj_spider import MojSpider
+
+PARSE_TIMES = []
+
+
+class TimedMojSpider(MojSpider):
+    """MojSpider recording the CPU time spent inside parse for each response."""
+
+    name = 'moj_bench'
+
+    def parse(self, response):
+        elapsed = 0.0
+        results = super().parse(response)
+        while True:
+            started = time.perf_counter()
+            try:
+                result = next(results)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - started
+            yield result
+        PARSE_TIMES.append(elapsed)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--rows-per-day', type=int, default=400)
+    parser.add_argument('--recorded', help='directory of recorded querydata responses')
+    parser.add_argument('--fail-429', type=float, default=0.0)
+    parser.add_argument('--fail-503', type=float, default=0.0)
+    parser.add_argument('--captcha', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--max-window', type=int, help='server truncates pages to this many rows')
+    parser.add_argument('--reject-window', type=int, help='server answers 400 to larger windows')
+    parser.add_argument('--error-window', type=int, help='server answers larger windows with an in-band error')
+    parser.add_argument('--concurrency', type=int, default=16, help='CONCURRENT_REQUESTS')
+    parser.add_argument('--download-delay', type=float, default=0.0)
+    parser.add_argument('-s', dest='settings', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra Scrapy setting')
+    parser.add_argument('-a', dest='spider_args', action='append', default=[], metavar='NAME=VALUE',
+                        help='MojSpider argument')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    settings = {
+        'LOG_LEVEL': 'WARNING',
+        'TELNETCONSOLE_ENABLED': False,
+        'CONCURRENT_REQUESTS': args.concurrency,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': args.concurrency,
+    }
+    settings.update(dict(setting.split('=', 1) for setting in args.settings))
+    # Spider custom_settings outrank process settings, so override them on the subclass.
+    TimedMojSpider.custom_settings = dict(MojSpider.custom_settings, DOWNLOAD_DELAY=args.download_delay)
+    spider_args = dict(arg.split('=', 1) for arg in args.spider_args)
+    # Keep the benchmark's checkpoints and watermark away from a real crawl's state file.
+    spider_args.setdefault('state_path', os.path.join(tempfile.gettempdir(), 'moj_bench_state.sqlite'))
+
+    server = ReplayServer(days=args.days, rows_per_day=args.rows_per_day, recorded_dir=args.recorded,
+                          fail_429=args.fail_429, fail_503=args.fail_503, captcha=args.captcha,
+                          latency=args.latency, max_window=args.max_window, reject_window=args.reject_window,
+                          error_window=args.error_window)
+    with server:
+        process = CrawlerProcess(settings)
+        crawler = process.create_crawler(TimedMojSpider)
+        process.crawl(crawler, report_url=server.url, **spider_args)
+        started = time.perf_counter()
+        process.start()
+        elapsed = time.perf_counter() - started
+
+    stats = crawler.stats.get_stats()
+    pages = len(PARSE_TIMES)
+    rows = stats.get('moj/transactions', 0)
+    report = {
+        'elapsed_s': round(elapsed, 3),
+        'pages': pages,
+        'rows': rows,
+        'pages_per_s': round(pages / elapsed, 2) if elapsed else 0,
+        'rows_per_s': round(rows / elapsed, 1) if elapsed else 0,
+        'parse_p50_ms': round(percentile(PARSE_TIMES, 0.50) * 1000, 2),
+        'parse_p99_ms': round(percentile(PARSE_TIMES, 0.99) * 1000, 2),
+        'parse_mean_ms': round(statistics.fmean(PARSE_TIMES) * 1000, 2) if PARSE_TIMES else 0,
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'server': server.counters,
+        'retries': {key: value for key, value in stats.items() if 'retry' in key},
+        'window': {key: value for key, value in stats.items() if key.startswith('window/')},
+    }
+    if args.json:
+        print(json.dumps(report, indent=2, default=str))
+        return
+    for key, value in report.items():
+        print(f'{key:<16} {value}')
+
+
+if __name__ == '__main__':
+    main()
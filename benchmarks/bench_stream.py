@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Peak memory and time of ``response.json()`` + decode versus the streaming
+DSRStream path on large querydata bodies.
+
+    python -m benchmarks.bench_stream [--rows 50000 200000] [FILE ...]
+
+FILEs are recorded querydata responses; without them synthetic bodies of
+``--rows`` rows are generated.  Each measurement runs in a fresh child
+process so peak RSS is not polluted by the other mode.
+"""
+import argparse
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date
+
+from benchmarks.synth import generate_rows, build_response, restart_token_for
+
+DICT_COLUMNS = {0: 'D0', 1: 'D1', 2: 'D2', 4: 'D3', 5: 'D4', 6: 'D5'}
+
+
+def decode(mode, body):
+    from dsr_decoder import decode_ds
+    from dsr_stream import DSRStream
+
+    if mode == 'json':
+        data = json.loads(body)
+        ds = data['results'][0]['result']['data']['dsr']['DS'][0]
+        return decode_ds(ds, dict_columns=DICT_COLUMNS), ds.get('RT')
+    stream = DSRStream(body)
+    return stream.decode(dict_columns=DICT_COLUMNS), stream.restart_token
+
+
+def run_child(mode, path):
+    with open(path, 'rb') as f:
+        body = f.read()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    columns, restart_token = decode(mode, body)
+    elapsed = time.perf_counter() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rows = len(columns[0])
+    del columns
+    gc.collect()
+
+    # Second pass under tracemalloc for the Python heap peak (slower, untimed).
+    tracemalloc.start()
+    decode(mode, body)
+    heap_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(json.dumps({'rows': rows, 'seconds': elapsed, 'peak_kb': peak, 'delta_kb': peak - baseline,
+                      'heap_peak_kb': heap_peak // 1024, 'rt': restart_token is not None}))
+
+
+def generate(n_rows, path):
+    rows = generate_rows(date(2024, 1, 31), -(-n_rows // 250), 250)[:n_rows]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(build_response(rows, restart_token_for(rows[-1])), f, ensure_ascii=False)
+
+
+def measure(mode, path):
+    output = subprocess.check_output([sys.executable, '-m', 'benchmarks.bench_stream', '--child', mode, path])
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*')
+    parser.add_argument('--rows', type=int, nargs='+', default=[50000, 200000])
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'FILE'), help=argparse.SUPPRESS)
+    parser.add_argument('--generate', nargs=2, metavar=('ROWS', 'FILE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(*args.child)
+        return
+    if args.generate:
+        generate(int(args.generate[0]), args.generate[1])
+        return
+
+    cases = [(os.path.basename(path), path) for path in args.files]
+    tmpdir = tempfile.TemporaryDirectory()
+    if not cases:
+        for n_rows in args.rows:
+            path = os.path.join(tmpdir.name, f'synthetic_{n_rows}.json')
+            # Generated out of process: a child inherits its parent's peak RSS on Linux.
+            subprocess.check_call([sys.executable, '-m', 'benchmarks.bench_stream', '--generate', str(n_rows), path])
+            cases.append((f'synthetic {n_rows} rows', path))
+
+    print(f"{'body':<26} {'MB':>6} {'mode':>7} {'rows':>7} {'sec':>7} {'peak RSS MB':>12} {'+RSS MB':>8} {'heap MB':>8}")
+    with tmpdir:
+        for label, path in cases:
+            size = os.path.getsize(path) / 2 ** 20
+            for mode in ('json', 'stream'):
+                result = measure(mode, path)
+                print(f"{label:<26} {size:>6.1f} {mode:>7} {result['rows']:>7} {result['seconds']:>7.3f} "
+                      f"{result['peak_kb'] / 1024:>12.1f} {result['delta_kb'] / 1024:>8.1f} {result['heap_peak_kb'] / 1024:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the Power BI ``querydata`` endpoint.
+
+Serves either synthetic TransactionSale pages (honouring the Where
+conditions, window size and RestartTokens of each request) or a directory
+of recorded responses chained by their ``RT`` values, and can inject
+429/503 responses and empty-``results`` captcha pages. ``max_window`` caps
+the rows of a page like a service truncating large windows,
+``reject_window`` answers 400 to larger windows and ``error_window`` answers
+them with an in-band ``odata.error`` data shape.
+
+    python -m benchmarks.replay_server --port 8765 --fail-429 0.02 --captcha 0.01
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.synth import generate_rows, build_response, restart_token_for
+from semantic_query import EQUAL, GREATER_THAN, GREATER_THAN_OR_EQUAL, LESS_THAN, LESS_THAN_OR_EQUAL
+
+QUERYDATA_PATH = '/public/reports/querydata'
+CAPTCHA_BODY = {'jobIds': ['00000000-0000-0000-0000-000000000000'], 'results': []}
+ERROR_BODY = {'results': [{'jobId': '00000000-0000-0000-0000-000000000000', 'result': {'data': {'dsr': {
+    'Version': 2, 'MinorVersion': 1,
+    'DataShapes': [{'Id': 'DS0', 'odata.error': {'code': 'rsQueryMemoryLimitExceeded', 'message': {
+        'lang': 'en-US', 'value': 'The query exceeded the memory limit.'}}}]}}}}]}
+
+
+def parse_literal(literal):
+    value = literal['Literal']['Value']
+    if value.startswith("'") and value.endswith("'"):
+        return value[1:-1].replace("''", "'")
+    if value.endswith('L'):
+        return int(value[:-1])
+    if value.endswith('D'):
+        return float(value[:-1])
+    return value
+
+
+def compile_where(where, properties):
+    """Turn SemanticQuery Where conditions into a row predicate."""
+    tests = []
+    for entry in where or []:
+        condition = entry['Condition']
+        if 'Comparison' in condition:
+            comparison = condition['Comparison']
+            index = properties[comparison['Left']['Column']['Property']]
+            value = parse_literal(comparison['Right'])
+            operator = {
+                EQUAL: lambda a, b: a == b,
+                GREATER_THAN: lambda a, b: a > b,
+                GREATER_THAN_OR_EQUAL: lambda a, b: a >= b,
+                LESS_THAN: lambda a, b: a < b,
+                LESS_THAN_OR_EQUAL: lambda a, b: a <= b,
+            }[comparison['ComparisonKind']]
+            tests.append(lambda row, i=index, v=value, op=operator: row[i] is not None and op(row[i], v))
+        else:
+            raise ValueError(f'Unsupported condition {sorted(condition)}')
+    return lambda row: all(test(row) for test in tests)
+
+
+class ReplayServer(object):
+    """Threaded querydata server; use as a context manager or start()/stop()."""
+
+    def __init__(self, host='127.0.0.1', port=0, days=90, rows_per_day=400, end_date=None, recorded_dir=None,
+                 fail_429=0.0, fail_503=0.0, captcha=0.0, retry_after=1, latency=0.0, seed=0, max_window=None,
+                 reject_window=None, error_window=None):
+        self.rows = [] if recorded_dir else generate_rows(end_date or date.today(), days, rows_per_day, seed=seed)
+        self.recorded = self.load_recorded(recorded_dir) if recorded_dir else None
+        self.fail_429 = fail_429
+        self.fail_503 = fail_503
+        self.captcha = captcha
+        self.retry_after = retry_after
+        self.latency = latency
+        self.max_window = max_window
+        self.reject_window = reject_window
+        self.error_window = error_window
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'pages': 0, 'rows': 0, '429': 0, '503': 0, 'captcha': 0}
+        self._filtered = {}
+        self.httpd = ThreadingHTTPServer((host, port), self.handler_class())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}{QUERYDATA_PATH}?synchronous=true'
+
+    @staticmethod
+    def load_recorded(path):
+        """Recorded bodies in file-name order, keyed by the RT that leads to each of them."""
+        pages = {}
+        previous_token = None
+        for name in sorted(os.listdir(path)):
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(path, name), 'rb') as f:
+                body = f.read()
+            pages[previous_token] = body
+            data = json.loads(body)
+            previous_token = json.dumps(data['results'][0]['result']['data']['dsr']['DS'][0].get('RT'))
+        return pages
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                status, headers, body = server.respond(self.rfile.read(length))
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.counters[key] += value
+
+    def roll(self, probability):
+        with self.lock:
+            return self.random.random() < probability
+
+    def respond(self, body):
+        self.count('requests')
+        if self.latency:
+            time.sleep(self.latency)
+        if self.roll(self.fail_429):
+            self.count('429')
+            return 429, {'Retry-After': str(self.retry_after)}, b'{"error":"TooManyRequests"}'
+        if self.roll(self.fail_503):
+            self.count('503')
+            return 503, {}, b'{"error":"ServiceUnavailable"}'
+        if self.roll(self.captcha):
+            self.count('captcha')
+            return 200, {'Content-Type': 'application/json'}, json.dumps(CAPTCHA_BODY).encode()
+
+        query = json.loads(body)
+        command = query['queries'][0]['Query']['Commands'][0]['SemanticQueryDataShapeCommand']
+        window = command['Binding']['DataReduction']['Primary']['Window']
+        restart_token = window.get('RestartTokens')
+        count = window.get('Count', 500)
+        if self.reject_window and count > self.reject_window:
+            return 400, {}, b'{"error":"DataShapeResultTooLarge"}'
+        if self.error_window and count > self.error_window:
+            return 200, {'Content-Type': 'application/json'}, json.dumps(ERROR_BODY).encode()
+        if self.max_window:
+            count = min(count, self.max_window)
+        if self.recorded is not None:
+            page = self.recorded.get(json.dumps(restart_token) if restart_token is not None else None)
+            if page is None:
+                return 400, {}, b'{"error":"UnknownRestartToken"}'
+            self.count('pages')
+            return 200, {'Content-Type': 'application/json'}, page
+
+        rows, positions = self.filtered_rows(command['Query'])
+        start = 0
+        if restart_token is not None:
+            # Synthetic tokens end with the id of the last row served (see synth.restart_token_for).
+            start = positions.get(int(restart_token[0][-1][:-1]), len(rows) - 1) + 1
+        page = rows[start:start + count]
+        has_more = start + len(page) < len(rows)
+        self.count('pages')
+        self.count('rows', len(page))
+        response = build_response(page, restart_token_for(page[-1]) if page and has_more else None)
+        return 200, {'Content-Type': 'application/json'}, json.dumps(response).encode()
+
+    def filtered_rows(self, semantic_query):
+        key = json.dumps(semantic_query.get('Where'), sort_keys=True)
+        filtered = self._filtered.get(key)
+        if filtered is None:
+            properties = {select[kind]['Property']: i for i, select in enumerate(semantic_query['Select'])
+                          for kind in ('Column', 'Measure') if kind in select}
+            matches = compile_where(semantic_query.get('Where'), properties)
+            rows = [row for row in self.rows if matches(row)]
+            filtered = self._filtered[key] = rows, {row[3]: i for i, row in enumerate(rows)}
+        return filtered
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--days', type=int, default=90)
+    parser.add_argument('--rows-per-day', type=int, default=400)
+    parser.add_argument('--recorded', help='directory of recorded querydata responses')
+    parser.add_argument('--fail-429', type=float, default=0.0, help='probability of a 429 response')
+    parser.add_argument('--fail-503', type=float, default=0.0, help='probability of a 503 response')
+    parser.add_argument('--captcha', type=float, default=0.0, help='probability of an empty-results response')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-window', type=int, help='truncate pages to this many rows')
+    parser.add_argument('--reject-window', type=int, help='answer 400 to larger windows')
+    parser.add_argument('--error-window', type=int, help='answer larger windows with an in-band error')
+    args = parser.parse_args()
+
+    server = ReplayServer(args.host, args.port, days=args.days, rows_per_day=args.rows_per_day,
+                          recorded_dir=args.recorded, fail_429=args.fail_429, fail_503=args.fail_503,
+                          captcha=args.captcha, latency=args.latency, seed=args.seed, max_window=args.max_window,
+                          reject_window=args.reject_window, error_window=args.error_window)
+    print(f'Serving querydata on {server.url}')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        print(json.dumps(server.counters))
+
+
+if __name__ == '__main__':
+    main()
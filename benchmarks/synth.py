@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic Power BI querydata responses shaped like the moj.gov.sa
+TransactionSale report, for benchmarks and offline runs.
+"""
+import random
+from datetime import timedelta, date
+
+REGIONS = ['منطقة الرياض', 'منطقة مكة المكرمة', 'المنطقة الشرقية', 'منطقة القصيم', 'منطقة عسير']
+CITIES = ['الرياض', 'جدة', 'مكة المكرمة', 'الدمام', 'الخبر', 'بريدة', 'أبها', 'الطائف']
+NEIGHBORHOODS = ['حي %d' % i for i in range(1, 121)]
+CLASSIFICATIONS = ['سكني', 'تجاري', 'زراعي', 'صناعي']
+
+# (name, schema type, ValueDicts key or None) in Select order
+COLUMNS = [
+    ('NotarizationWork.المنطقة', 1, 'D0'),
+    ('NotarizationWork.المدينة', 1, 'D1'),
+    ('TransactionSale.الحي', 1, 'D2'),
+    ('CountNonNull(TransactionSale.الرقم المرجعي للصفقة)', 4, None),
+    ('TransactionSale.HDate', 1, 'D3'),
+    ('TransactionSale.تاريخ الصفقة ميلادي', 1, 'D4'),
+    ('TransactionSale.تصنيف العقار', 1, 'D5'),
+    ('Sum(TransactionSale.السعر)', 3, None),
+    ('Sum(TransactionSale.المساحة)', 3, None),
+    ('TransactionSale.عدد العقارات', 4, None),
+]
+
+
+def hijri_label(day):
+    # Not a real calendar conversion, only a plausible, date-unique label.
+    offset = (day - date(2000, 1, 1)).days
+    return '%04d/%02d/%02d' % (1420 + offset // 354, offset % 354 // 30 % 12 + 1, offset % 354 % 30 + 1)
+
+
+def generate_rows(end_date, days, rows_per_day, seed=0, null_rate=0.01):
+    """Logical rows (decoded values) sorted by date desc, price desc."""
+    rnd = random.Random(seed)
+    rows = []
+    next_id = 1000000 + seed * 10000000
+    for offset in range(days):
+        day = end_date - timedelta(days=offset)
+        day_rows = []
+        for _ in range(rows_per_day):
+            next_id += 1
+            space = round(rnd.uniform(100, 5000), 2) if rnd.random() >= null_rate else None
+            day_rows.append([
+                rnd.choice(REGIONS),
+                rnd.choice(CITIES),
+                rnd.choice(NEIGHBORHOODS),
+                next_id,
+                hijri_label(day),
+                day.strftime('%Y/%m/%d'),
+                rnd.choice(CLASSIFICATIONS),
+                float(rnd.randrange(50, 5000) * 1000),
+                space,
+                rnd.choice([1, 1, 1, 2, 3]),
+            ])
+        day_rows.sort(key=lambda r: r[7], reverse=True)
+        rows.extend(day_rows)
+    return rows
+
+
+def build_ds(rows, restart_token=None):
+    """Encode logical rows as a ``dsr.DS[0]`` entry with R/Ø compression."""
+    value_dicts = {}
+    indexes = {}
+    for _, _, dict_key in COLUMNS:
+        if dict_key:
+            value_dicts[dict_key] = []
+            indexes[dict_key] = {}
+
+    dm0 = []
+    previous = None
+    for row in rows:
+        encoded = []
+        for (_, _, dict_key), value in zip(COLUMNS, row):
+            if dict_key and value is not None:
+                index = indexes[dict_key].get(value)
+                if index is None:
+                    index = indexes[dict_key][value] = len(value_dicts[dict_key])
+                    value_dicts[dict_key].append(value)
+                value = index
+            encoded.append(value)
+        entry = {}
+        repeat = nulls = 0
+        values = []
+        for i, value in enumerate(encoded):
+            if previous is not None and previous[i] == value:
+                repeat |= 1 << i
+            elif value is None:
+                nulls |= 1 << i
+            else:
+                values.append(value)
+        if previous is None:
+            entry['S'] = [{'N': 'G%d' % i, 'T': t, 'DN': k} if k else {'N': 'G%d' % i, 'T': t}
+                          for i, (_, t, k) in enumerate(COLUMNS)]
+        entry['C'] = values
+        if repeat:
+            entry['R'] = repeat
+        if nulls:
+            entry['Ø'] = nulls
+        dm0.append(entry)
+        previous = encoded
+
+    ds = {'N': 'DS0', 'PH': [{'DM0': dm0}], 'IC': True, 'HAD': True, 'ValueDicts': value_dicts}
+    if restart_token is not None:
+        ds['RT'] = restart_token
+    return ds
+
+
+def build_response(rows, restart_token=None):
+    """Wrap a page of logical rows in a full querydata response body."""
+    select = [{'Kind': 1, 'Depth': 0, 'Value': 'G%d' % i, 'GroupKeys': [], 'Name': name}
+              for i, (name, _, _) in enumerate(COLUMNS)]
+    return {
+        'jobIds': ['00000000-0000-0000-0000-000000000000'],
+        'results': [{
+            'jobId': '00000000-0000-0000-0000-000000000000',
+            'result': {'data': {
+                'descriptor': {'Select': select, 'Expressions': {'Primary': {'Groupings': [{'Keys': [], 'Member': 'DM0'}]}}, 'Version': 2},
+                'dsr': {'Version': 2, 'MinorVersion': 1, 'DS': [build_ds(rows, restart_token)]},
+                'metrics': {'Version': '1.0.0', 'Events': []},
+            }},
+        }],
+    }
+
+
+def restart_token_for(row):
+    """A RestartTokens value pointing after ``row`` (date, price, id)."""
+    return [["'%s'" % row[5], '%sD' % row[7], '%dL' % row[3]]]
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Local, SQLite-backed state shared between crawl runs.
+"""
+import json
+import sqlite3
+
+
+class CrawlState(object):
+    """Persisted per-site crawl state (delta-crawl watermarks, RestartToken chain checkpoints and the ids
+    emitted up to those checkpoints)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS watermarks ('
+                ' site TEXT PRIMARY KEY,'
+                ' date TEXT NOT NULL,'
+                ' ids TEXT NOT NULL,'
+                ' updated_at TEXT DEFAULT CURRENT_TIMESTAMP)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS checkpoints ('
+                ' site TEXT NOT NULL,'
+                ' shard TEXT NOT NULL,'
+                ' query TEXT NOT NULL,'
+                ' restart_token TEXT,'
+                ' page INTEGER NOT NULL,'
+                ' rows INTEGER NOT NULL,'
+                ' high_water_date TEXT,'
+                ' high_water_ids TEXT,'
+                ' done INTEGER NOT NULL,'
+                ' updated_at TEXT DEFAULT CURRENT_TIMESTAMP,'
+                ' PRIMARY KEY (site, shard, query))')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS seen_ids ('
+                ' site TEXT NOT NULL,'
+                ' id TEXT NOT NULL,'
+                ' PRIMARY KEY (site, id))')
+
+    def watermark(self, site):
+        """The last-seen transaction date and the ids seen on that date, or (None, set())."""
+        row = self.connection.execute('SELECT date, ids FROM watermarks WHERE site = ?', (site,)).fetchone()
+        if row is None:
+            return None, set()
+        return row[0], set(json.loads(row[1]))
+
+    def set_watermark(self, site, date, ids):
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO watermarks (site, date, ids, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)',
+                (site, date, json.dumps(sorted(ids, key=str))))
+
+    def checkpoints(self, site):
+        """Checkpointed chains of ``site`` keyed by (shard, query), as dicts."""
+        cursor = self.connection.execute(
+            'SELECT shard, query, restart_token, page, rows, high_water_date, high_water_ids, done'
+            ' FROM checkpoints WHERE site = ?', (site,))
+        return {
+            (shard, query): {
+                'restart_token': json.loads(restart_token) if restart_token else None,
+                'page': page,
+                'rows': rows,
+                'high_water_date': high_water_date,
+                'high_water_ids': set(json.loads(high_water_ids)) if high_water_ids else set(),
+                'done': bool(done),
+            }
+            for shard, query, restart_token, page, rows, high_water_date, high_water_ids, done in cursor
+        }
+
+    def set_checkpoints(self, site, checkpoints, seen_ids=()):
+        """Record where chains continue from and the ids emitted before that, in one transaction.
+
+        ``checkpoints`` are dicts with the keys returned by :meth:`checkpoints` plus ``shard`` and ``query``.
+        """
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO checkpoints'
+                ' (site, shard, query, restart_token, page, rows, high_water_date, high_water_ids, done, updated_at)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)',
+                [(site, c['shard'], c['query'],
+                  json.dumps(c['restart_token']) if c['restart_token'] is not None else None, c['page'], c['rows'],
+                  c['high_water_date'],
+                  json.dumps(sorted(c['high_water_ids'], key=str)) if c['high_water_date'] else None,
+                  int(c['done'])) for c in checkpoints])
+            self.connection.executemany('INSERT OR IGNORE INTO seen_ids (site, id) VALUES (?, ?)',
+                                        [(site, json.dumps(row_id)) for row_id in seen_ids])
+
+    def seen_ids(self, site):
+        return {json.loads(row_id) for row_id, in self.connection.execute(
+            'SELECT id FROM seen_ids WHERE site = ?', (site,))}
+
+    def clear_checkpoints(self, site):
+        with self.connection:
+            self.connection.execute('DELETE FROM checkpoints WHERE site = ?', (site,))
+            self.connection.execute('DELETE FROM seen_ids WHERE site = ?', (site,))
+
+    def close(self):
+        self.connection.close()
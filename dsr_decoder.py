@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar decoder for Power BI DSR (data shape result) pages.
+
+Rows in ``DS[0].PH[0].DM0`` are delta-compressed: ``R`` is a bitmask of
+columns repeated from the previous row, ``Ø`` a bitmask of null columns,
+and ``C`` holds only the remaining values, in column order.  Columns backed
+by a ``ValueDicts`` entry carry integer indexes into that dictionary.
+
+The decoder expands every row into a full tuple with a cached
+``operator.itemgetter`` per (R, Ø) combination, transposes the page with
+``zip`` and resolves dictionary indexes column by column, so there is no
+per-cell Python branching and no ``list.pop(0)``.
+"""
+from operator import itemgetter
+
+REPEAT_KEY = 'R'
+NULL_KEY = 'Ø'
+VALUES_KEY = 'C'
+SCHEMA_KEY = 'S'
+
+_NO_MASKS = (0, 0)
+# Rows are transposed into the column buffers in chunks of this size, so the
+# expanded row tuples never outlive a chunk.
+CHUNK_ROWS = 4096
+
+
+class DM0Decoder(object):
+    """Incrementally decode DM0 rows into columns.
+
+    ``dict_columns`` maps a column index to its ``ValueDicts`` key
+    (e.g. ``{0: 'D0'}``); when omitted it is taken from the ``DN`` entries of
+    the first row's ``S`` schema.  Rows are fed one by one or in bulk and the
+    columns are materialized by :meth:`finish`.
+    """
+
+    def __init__(self, n_columns=None, dict_columns=None):
+        self.n_columns = n_columns
+        self.dict_columns = dict(dict_columns) if dict_columns is not None else None
+        self.schema = None
+        self.n_rows = 0
+        self._columns = None
+        self._pending = []
+        self._previous = None
+        self._getters = {}
+
+    def _getter(self, repeat, nulls):
+        key = (repeat, nulls)
+        getter = self._getters.get(key)
+        if getter is None:
+            # Index into ``previous + C + (None,)``: previous values live at
+            # [0, n), the packed C values start at n and -1 is the null.
+            n = self.n_columns
+            indexes = []
+            position = n
+            for i in range(n):
+                bit = 1 << i
+                if repeat & bit:
+                    indexes.append(i)
+                elif nulls & bit:
+                    indexes.append(-1)
+                else:
+                    indexes.append(position)
+                    position += 1
+            getter = self._getters[key] = itemgetter(*indexes)
+        return getter
+
+    def feed(self, row):
+        self.feed_many((row,))
+
+    def feed_many(self, rows):
+        rows = iter(rows)
+        if self.n_columns is None or self._previous is None:
+            first = next(rows, None)
+            if first is None:
+                return
+            self.schema = first.get(SCHEMA_KEY)
+            if self.n_columns is None:
+                self.n_columns = len(self.schema) if self.schema else len(first.get(VALUES_KEY, ()))
+            if self.dict_columns is None:
+                self.dict_columns = {i: entry['DN'] for i, entry in enumerate(self.schema or ()) if 'DN' in entry}
+            self._previous = (None,) * self.n_columns
+            self._columns = [[] for _ in range(self.n_columns)]
+            self._feed_rows((first,))
+        self._feed_rows(rows)
+
+    def _feed_rows(self, rows):
+        # Hot loop: keep every lookup local.
+        getters = self._getters
+        make_getter = self._getter
+        pending = self._pending
+        append = pending.append
+        single = self.n_columns == 1
+        previous = self._previous
+        for row in rows:
+            values = row.get(VALUES_KEY, ())
+            masks = (row.get(REPEAT_KEY, 0), row.get(NULL_KEY, 0))
+            if masks == _NO_MASKS:
+                previous = tuple(values)
+            else:
+                getter = getters.get(masks) or make_getter(*masks)
+                previous = getter((*previous, *values, None))
+                if single:
+                    previous = (previous,)
+            append(previous)
+            if len(pending) >= CHUNK_ROWS:
+                self._flush()
+        self._previous = previous
+
+    def _flush(self):
+        pending = self._pending
+        if pending:
+            for column, values in zip(self._columns, zip(*pending)):
+                column.extend(values)
+            self.n_rows += len(pending)
+            pending.clear()
+
+    def finish(self, value_dicts=None):
+        """Return the decoded page as a list of per-column lists."""
+        n = self.n_columns or 0
+        if self._columns is None:
+            return [[] for _ in range(n)]
+        self._flush()
+        columns = self._columns
+        value_dicts = value_dicts or {}
+        for index, dict_key in (self.dict_columns or {}).items():
+            lookup = value_dicts.get(dict_key)
+            if lookup is not None and index < n:
+                columns[index] = resolve_column(columns[index], lookup)
+        return columns
+
+
+def resolve_column(column, lookup):
+    """Replace integer dictionary indexes in ``column`` with their values."""
+    try:
+        # Fast path: every cell is an index (no nulls, no inline literals).
+        return list(map(lookup.__getitem__, column))
+    except TypeError:
+        return [lookup[value] if value.__class__ is int else value for value in column]
+
+
+def decode_dm0(rows, value_dicts=None, dict_columns=None, n_columns=None):
+    """Decode a DM0 row list into a list of per-column lists."""
+    decoder = DM0Decoder(n_columns=n_columns, dict_columns=dict_columns)
+    decoder.feed_many(rows)
+    return decoder.finish(value_dicts)
+
+
+def decode_ds(ds, dict_columns=None, n_columns=None):
+    """Decode the first primary hierarchy of a ``dsr.DS[i]`` entry."""
+    rows = ds.get('PH', [{}])[0].get('DM0', [])
+    return decode_dm0(rows, ds.get('ValueDicts', {}), dict_columns=dict_columns, n_columns=n_columns)
+
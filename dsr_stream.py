@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental parsing of Power BI querydata responses.
+
+Rather than building the whole document with ``json.loads``, the scanner
+walks the body once down to ``results[0].result.data.dsr.DS[0]``, skipping
+everything off that path, then yields the ``PH[0].DM0`` rows one at a time
+while picking up ``ValueDicts`` and ``RT`` on the way.  Only one row is
+materialized at a time, so peak memory is the body text plus the decoded
+columns instead of the body plus the full parsed tree.
+"""
+import json
+import re
+
+from dsr_decoder import DM0Decoder
+
+DS_PATH = ('results', 0, 'result', 'data', 'dsr', 'DS', 0)
+
+# What a querydata body holds, see response_kind()
+RESULTS = 'results'
+EMPTY_RESULTS = 'empty_results'
+ERROR = 'error'
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+class _Scanner(object):
+    """Minimal pull parser over a JSON string, built on ``raw_decode``."""
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+
+    def peek(self):
+        self.pos = _whitespace.match(self.text, self.pos).end()
+        return self.text[self.pos:self.pos + 1]
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f'Expected {char!r} at offset {self.pos}')
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        value, self.pos = _decoder.raw_decode(self.text, self.pos)
+        return value
+
+    def skip(self):
+        self.value()
+
+    def _members(self, opening, closing, read_key):
+        # The caller must consume each member's value before resuming.
+        self.expect(opening)
+        if self.peek() == closing:
+            self.pos += 1
+            return
+        index = 0
+        while True:
+            if read_key:
+                key = self.value()
+                self.expect(':')
+                yield key
+            else:
+                yield index
+                index += 1
+            separator = self.peek()
+            self.pos += 1
+            if separator == closing:
+                return
+            if separator != ',':
+                raise ValueError(f'Expected {closing!r} or \',\' at offset {self.pos - 1}')
+
+    def keys(self):
+        return self._members('{', '}', True)
+
+    def indexes(self):
+        return self._members('[', ']', False)
+
+    def descend(self, step):
+        """Move to the value at ``step`` (a key or an index); False if absent."""
+        members = self.keys() if isinstance(step, str) else self.indexes()
+        for member in members:
+            if member == step:
+                return True
+            self.skip()
+        return False
+
+
+class DSRStream(object):
+    """Stream the first data shape of a querydata response body.
+
+    ``has_results``, ``empty_results`` (an empty ``results`` list, a captcha page) and
+    ``descriptor`` (the query's ``descriptor``, which maps ``G0``.. schema names to
+    Select names) are known right after construction;
+    ``value_dicts`` and ``restart_token`` are complete once :meth:`rows` has been exhausted.
+    """
+
+    def __init__(self, text):
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+        self._scanner = _Scanner(text)
+        self.value_dicts = {}
+        self.restart_token = None
+        self.descriptor = None
+        self.empty_results = False
+        self.has_results = self._descend_results()
+
+    def _descend_results(self):
+        scanner = self._scanner
+        if not scanner.descend('results') or scanner.peek() != '[':
+            return False
+        if not scanner.descend(0):
+            self.empty_results = True
+            return False
+        for step in DS_PATH[2:]:
+            if step == 'dsr':
+                found = self._descend_data()
+            else:
+                found = scanner.descend(step)
+            if not found:
+                raise KeyError(f"querydata response has no {'.'.join(map(str, DS_PATH))}")
+        return True
+
+    def _descend_data(self):
+        # Like descend('dsr') on result.data, but keeping the descriptor on the way.
+        scanner = self._scanner
+        for key in scanner.keys():
+            if key == 'dsr':
+                return True
+            if key == 'descriptor':
+                self.descriptor = scanner.value()
+            else:
+                scanner.skip()
+        return False
+
+    def rows(self):
+        """Yield ``DM0`` rows of ``PH[0]`` in order."""
+        if not self.has_results:
+            return
+        scanner = self._scanner
+        for key in scanner.keys():
+            if key == 'PH':
+                for index in scanner.indexes():
+                    if index != 0:
+                        scanner.skip()
+                        continue
+                    for member in scanner.keys():
+                        if member != 'DM0':
+                            scanner.skip()
+                            continue
+                        for _ in scanner.indexes():
+                            yield scanner.value()
+            elif key == 'ValueDicts':
+                self.value_dicts = scanner.value()
+            elif key == 'RT':
+                self.restart_token = scanner.value()
+            else:
+                scanner.skip()
+
+    def decode(self, dict_columns=None, n_columns=None):
+        """Decode the streamed rows into per-column lists."""
+        decoder = DM0Decoder(n_columns=n_columns, dict_columns=dict_columns)
+        decoder.feed_many(self.rows())
+        return decoder.finish(self.value_dicts)
+
+
+def response_kind(body):
+    """RESULTS if a querydata body carries a data shape, EMPTY_RESULTS for an empty ``results`` list
+    (a captcha page, worth retrying) and ERROR for anything else: an in-band error such as
+    ``dsr.DataShapes`` with ``odata.error``, or a body that isn't JSON. Retrying those doesn't help.
+    """
+    try:
+        stream = DSRStream(body)
+    except (KeyError, ValueError):
+        return ERROR
+    if stream.has_results:
+        return RESULTS
+    return EMPTY_RESULTS if stream.empty_results else ERROR
+
+
+def has_results(body):
+    """True if a querydata body carries a data shape."""
+    return response_kind(body) == RESULTS
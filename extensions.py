@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+
+from dsr_stream import response_kind, EMPTY_RESULTS
+from metrics import openmetrics, write_atomic
+
+logger = logging.getLogger(__name__)
+
+# Empty-results (captcha) pages are tiny; real pages are far above this.
+CAPTCHA_MAX_BYTES = 4096
+
+
+class QueryDataAIMDThrottle(object):
+    """AIMD concurrency and delay control for the Power BI querydata endpoint.
+
+    Per download slot (one per host, or per proxy when a middleware sets
+    ``download_slot``), the number of requests in flight grows additively
+    (about +1 per window of successful responses) and the delay shrinks
+    additively, while a congestion signal (429/503, an empty-results page, or a
+    download latency above the target) halves the window and doubles the
+    delay, at most once per cooldown so one burst counts as one event.
+
+    Settings:
+        QUERYDATA_AIMD_ENABLED         enable the controller (default False)
+        QUERYDATA_AIMD_START_WINDOW    initial requests in flight per slot (default 2)
+        QUERYDATA_AIMD_MIN_WINDOW      (default 1)
+        QUERYDATA_AIMD_MAX_WINDOW      (default 16)
+        QUERYDATA_AIMD_DECREASE        multiplicative decrease factor (default 0.5)
+        QUERYDATA_AIMD_TARGET_LATENCY  latency in seconds treated as congestion (default 5)
+        QUERYDATA_AIMD_MIN_DELAY       (default 0)
+        QUERYDATA_AIMD_MAX_DELAY       (default 10)
+        QUERYDATA_AIMD_DELAY_STEP      additive delay decrease per success (default 0.01)
+        QUERYDATA_AIMD_DEBUG           log every decision (default False)
+
+    The initial delay is DOWNLOAD_DELAY. Current window and delay per slot and
+    the increase/decrease decisions are kept under ``aimd/`` in the crawl stats.
+    """
+
+    congestion_statuses = (429, 503)
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('QUERYDATA_AIMD_ENABLED'):
+            raise NotConfigured
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.start_window = settings.getfloat('QUERYDATA_AIMD_START_WINDOW', 2)
+        self.min_window = settings.getfloat('QUERYDATA_AIMD_MIN_WINDOW', 1)
+        self.max_window = settings.getfloat('QUERYDATA_AIMD_MAX_WINDOW', 16)
+        self.decrease = settings.getfloat('QUERYDATA_AIMD_DECREASE', 0.5)
+        self.target_latency = settings.getfloat('QUERYDATA_AIMD_TARGET_LATENCY', 5.0)
+        self.start_delay = settings.getfloat('DOWNLOAD_DELAY')
+        self.min_delay = settings.getfloat('QUERYDATA_AIMD_MIN_DELAY', 0.0)
+        self.max_delay = settings.getfloat('QUERYDATA_AIMD_MAX_DELAY', 10.0)
+        self.delay_step = settings.getfloat('QUERYDATA_AIMD_DELAY_STEP', 0.01)
+        self.debug = settings.getbool('QUERYDATA_AIMD_DEBUG')
+        self.windows = {}
+        self.last_decrease = {}
+        crawler.signals.connect(self._request_reached_downloader, signal=signals.request_reached_downloader)
+        crawler.signals.connect(self._response_downloaded, signal=signals.response_downloaded)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def _get_slot(self, request):
+        key = request.meta.get('download_slot')
+        return key, self.crawler.engine.downloader.slots.get(key)
+
+    def _request_reached_downloader(self, request, spider):
+        if 'chain' not in request.meta:
+            return
+        key, slot = self._get_slot(request)
+        if slot is None or key in self.windows:
+            return
+        self.windows[key] = self.start_window
+        slot.delay = self.start_delay
+        self._apply(key, slot)
+
+    def _response_downloaded(self, response, request, spider):
+        if 'chain' not in request.meta:
+            return
+        key, slot = self._get_slot(request)
+        if slot is None:
+            return
+        window = self.windows.setdefault(key, self.start_window)
+        latency = request.meta.get('download_latency') or 0.0
+        reason = self.congestion(response, latency)
+
+        if reason is None:
+            window = min(self.max_window, window + 1.0 / max(window, 1.0))
+            slot.delay = max(self.min_delay, slot.delay - self.delay_step)
+            self.stats.inc_value('aimd/increase_count')
+        else:
+            now = time.monotonic()
+            cooldown = max(latency, slot.delay, 1.0)
+            if now - self.last_decrease.get(key, 0.0) < cooldown:
+                return
+            self.last_decrease[key] = now
+            window = max(self.min_window, window * self.decrease)
+            slot.delay = min(self.max_delay, max(slot.delay * 2, self.delay_step))
+            self.stats.inc_value('aimd/decrease_count')
+            self.stats.inc_value(f'aimd/decrease_reason/{reason}')
+            if self.debug:
+                logger.info(f'AIMD decrease on {key} ({reason}): window {window:.2f}, delay {slot.delay:.2f}s, '
+                            f'latency {latency:.2f}s')
+        self.windows[key] = window
+        self._apply(key, slot)
+
+    def congestion(self, response, latency):
+        if response.status in self.congestion_statuses:
+            return f'status_{response.status}'
+        # In-band errors are as small, but they reject the query rather than signal overload.
+        if response.status == 200 and len(response.body) < CAPTCHA_MAX_BYTES \
+                and response_kind(response.body) == EMPTY_RESULTS:
+            return 'empty_results'
+        if latency > self.target_latency:
+            return 'latency'
+        return None
+
+    def _apply(self, key, slot):
+        window = self.windows[key]
+        slot.concurrency = max(1, int(window))
+        self.stats.set_value(f'aimd/slot/{key}/window', round(window, 2))
+        self.stats.set_value(f'aimd/slot/{key}/delay', round(slot.delay, 3))
+        self.stats.max_value('aimd/max_window', slot.concurrency)
+        if self.debug:
+            logger.debug(f'AIMD {key}: window {window:.2f} (concurrency {slot.concurrency}), delay {slot.delay:.3f}s')
+
+
+class QueryDataMetricsExport(object):
+    """Write the crawl stats and per-page histograms as OpenMetrics text.
+
+    The file is rewritten every interval and once more when the spider closes,
+    for a Prometheus node_exporter textfile collector or a push job. Page
+    histograms (download latency, response bytes, parse and decode time, rows)
+    come from the spider's ``report.metrics`` when it has one.
+
+    Settings:
+        QUERYDATA_METRICS_PATH      output file; the extension is off when unset
+        QUERYDATA_METRICS_INTERVAL  seconds between dumps, 0 for only at close (default 60)
+        QUERYDATA_METRICS_NAMESPACE metric name prefix (default "scrapy")
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.path = settings.get('QUERYDATA_METRICS_PATH')
+        if not self.path:
+            raise NotConfigured
+        self.interval = settings.getfloat('QUERYDATA_METRICS_INTERVAL', 60.0)
+        self.namespace = settings.get('QUERYDATA_METRICS_NAMESPACE', 'scrapy')
+        self.stats = crawler.stats
+        self.task = None
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        if self.interval:
+            self.task = task.LoopingCall(self.dump, spider)
+            self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        self.dump(spider)
+
+    def dump(self, spider):
+        report = getattr(spider, 'report', None)
+        histograms = report.metrics.histograms if report is not None else None
+        write_atomic(self.path, openmetrics(self.stats.get_stats(), histograms, self.namespace))
+        logger.debug(f'Metrics written to {self.path}')
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP cache storage and policy for Power BI querydata pages.
+
+Plugs into Scrapy's HttpCacheMiddleware (``HTTPCACHE_ENABLED=True``) so a
+re-run or restarted crawl serves the pages it already fetched from disk and
+only goes to the network for the rest of each RestartToken chain.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+import zlib
+from urllib.parse import urlsplit
+
+from scrapy.extensions.httpcache import DummyPolicy
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+
+from dsr_stream import has_results
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(request):
+    """Hash of the request's endpoint, resource key and normalized JSON body.
+
+    The body is re-serialized with sorted keys so that equivalent queries (the
+    same model, Where conditions and ``RestartTokens``) share a key however they
+    were built. The endpoint is the URL without its query string, so pages of a
+    replay server (``report_url``) never stand in for the real service's.
+    """
+    try:
+        body = json.dumps(json.loads(request.body), sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    except ValueError:
+        body = request.body.decode('utf-8', 'replace')
+    url = urlsplit(request.url)
+    endpoint = f'{url.scheme}://{url.netloc}{url.path}'
+    resource_key = request.headers.get('X-PowerBI-ResourceKey', b'').decode('utf-8')
+    return hashlib.sha256('\n'.join([endpoint, resource_key, body]).encode('utf-8')).hexdigest()
+
+
+class QueryDataCachePolicy(DummyPolicy):
+    """Cache querydata pages (requests with a ``chain`` in meta) that carry results.
+
+    Empty ``results`` (captcha) pages and error statuses are never stored, so
+    QueryDataRetryMiddleware still sees and retries them. Expiry is handled by
+    the storage.
+    """
+
+    def should_cache_request(self, request):
+        return 'chain' in request.meta and super().should_cache_request(request)
+
+    def should_cache_response(self, response, request):
+        return response.status == 200 and has_results(response.body)
+
+
+class QueryDataCacheStorage(object):
+    """zlib-compressed querydata pages in one SQLite file per spider, under HTTPCACHE_DIR.
+
+    Pages of a ``closed`` chain (a date range entirely before the current
+    month) never change and are kept without expiry; other pages expire after
+    QUERYDATA_CACHE_TTL. Once the compressed bodies exceed QUERYDATA_CACHE_MAX_BYTES,
+    expired pages and then the least recently used ones are evicted.
+
+    Settings:
+        QUERYDATA_CACHE_TTL        seconds an open-range page stays fresh, 0 for no expiry (default 3600)
+        QUERYDATA_CACHE_MAX_BYTES  size bound of the stored bodies, 0 for unbounded (default 1 GiB)
+        QUERYDATA_CACHE_LEVEL      zlib compression level (default 6)
+
+    Hit and miss counts are in the ``httpcache/`` stats, evictions under ``querydata_cache/``.
+    """
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings['HTTPCACHE_DIR'], createdir=True)
+        self.ttl = settings.getint('QUERYDATA_CACHE_TTL', 3600)
+        self.max_bytes = settings.getint('QUERYDATA_CACHE_MAX_BYTES', 1 << 30)
+        self.level = settings.getint('QUERYDATA_CACHE_LEVEL', 6)
+        self.connection = None
+        self.size = 0
+        self.stats = None
+
+    def open_spider(self, spider):
+        path = os.path.join(self.cachedir, f'{spider.name}.sqlite')
+        self.stats = spider.crawler.stats
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS pages ('
+                ' key TEXT PRIMARY KEY,'
+                ' url TEXT NOT NULL,'
+                ' status INTEGER NOT NULL,'
+                ' headers TEXT NOT NULL,'
+                ' body BLOB NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' stored_at REAL NOT NULL,'
+                ' expires_at REAL,'
+                ' accessed_at REAL NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at)')
+        self.size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+        logger.debug(f'Using querydata cache in {path} ({self.size} bytes)')
+        if self.max_bytes and self.size > self.max_bytes:
+            self.evict(time.time())
+
+    def close_spider(self, spider):
+        self.stats.set_value('querydata_cache/bytes', self.size)
+        self.connection.close()
+
+    def retrieve_response(self, spider, request):
+        """Return the cached page for ``request``, or None if absent or expired."""
+        key = cache_key(request)
+        row = self.connection.execute(
+            'SELECT url, status, headers, body, expires_at FROM pages WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        url, status, raw_headers, body, expires_at = row
+        now = time.time()
+        if expires_at is not None and expires_at < now:
+            return None
+        with self.connection:
+            self.connection.execute('UPDATE pages SET accessed_at = ? WHERE key = ?', (now, key))
+        body = zlib.decompress(body)
+        headers = Headers(json.loads(raw_headers))
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=status, body=body)
+
+    def store_response(self, spider, request, response):
+        key = cache_key(request)
+        body = zlib.compress(response.body, self.level)
+        headers = {k.decode('latin-1'): [v.decode('latin-1') for v in values]
+                   for k, values in response.headers.items()}
+        now = time.time()
+        expires_at = None if request.meta['chain'].get('closed') or not self.ttl else now + self.ttl
+        with self.connection:
+            previous = self.connection.execute('SELECT size FROM pages WHERE key = ?', (key,)).fetchone()
+            self.connection.execute(
+                'INSERT OR REPLACE INTO pages (key, url, status, headers, body, size, stored_at, expires_at, accessed_at)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, response.url, response.status, json.dumps(headers), body, len(body), now, expires_at, now))
+        self.size += len(body) - (previous[0] if previous else 0)
+        if self.max_bytes and self.size > self.max_bytes:
+            self.evict(now)
+
+    def evict(self, now):
+        """Drop expired pages, then the least recently used ones, until under QUERYDATA_CACHE_MAX_BYTES."""
+        with self.connection:
+            expired = self.connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages WHERE expires_at < ?', (now,)).fetchone()
+            self.connection.execute('DELETE FROM pages WHERE expires_at < ?', (now,))
+            self.size -= expired[1]
+            evicted = expired[0]
+            if self.size > self.max_bytes:
+                keys = []
+                for key, size in self.connection.execute('SELECT key, size FROM pages ORDER BY accessed_at').fetchall():
+                    if self.size <= self.max_bytes:
+                        break
+                    keys.append((key,))
+                    self.size -= size
+                self.connection.executemany('DELETE FROM pages WHERE key = ?', keys)
+                evicted += len(keys)
+        self.stats.inc_value('querydata_cache/evicted', evicted)
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+from dataclasses import dataclass, field
+
+
+@dataclass
+class TransactionPage:
+    """A whole decoded querydata page as columns (field name -> values), yielded with yield_pages=true."""
+    columns: dict = field(default_factory=dict)
+    shard: str = None
+    page: int = 0
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()), ()))
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Per-page crawl metrics without Scrapy: fixed-bucket histograms, an
+OpenMetrics (Prometheus) text dump of them plus the crawl stats, and a
+sampling profiler for querydata page decoding.
+"""
+import cProfile
+import os
+import random
+import re
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BYTES_BUCKETS = (1 << 10, 1 << 12, 1 << 14, 1 << 16, 1 << 18, 1 << 20, 1 << 22, 1 << 24)
+ROWS_BUCKETS = (0, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Histogram name -> buckets of everything observed per querydata page
+PAGE_HISTOGRAMS = {
+    'download_latency_seconds': SECONDS_BUCKETS,
+    'response_bytes': BYTES_BUCKETS,
+    'parse_seconds': SECONDS_BUCKETS,
+    'decode_seconds': SECONDS_BUCKETS,
+    'rows': ROWS_BUCKETS,
+}
+
+
+class Histogram(object):
+    """Cumulative-on-export histogram with Prometheus ``le`` buckets."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class PageMetrics(object):
+    """Histograms of per-page download latency, response size, parse and decode time and rows."""
+
+    def __init__(self):
+        self.histograms = {name: Histogram(buckets) for name, buckets in PAGE_HISTOGRAMS.items()}
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+
+def metric_name(*parts):
+    return re.sub(r'[^a-zA-Z0-9_]+', '_', '_'.join(parts)).strip('_').lower()
+
+
+def openmetrics(stats, histograms=None, namespace='scrapy'):
+    """OpenMetrics text exposition of numeric ``stats`` (as gauges) and page ``histograms``."""
+    lines = []
+    seen = set()
+    for key, value in sorted(stats.items()):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        name = metric_name(namespace, key)
+        if name in seen:
+            continue
+        seen.add(name)
+        lines.append(f'# TYPE {name} gauge')
+        lines.append(f'{name} {value}')
+    for key, histogram in sorted((histograms or {}).items()):
+        name = metric_name(namespace, 'page', key)
+        lines.append(f'# TYPE {name} histogram')
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {histogram.count}')
+        lines.append(f'{name}_sum {histogram.sum}')
+        lines.append(f'{name}_count {histogram.count}')
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+def write_atomic(path, text):
+    """Write ``text`` to ``path`` through a temporary file, so readers never see a partial dump."""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class PageProfiler(object):
+    """Profile a random ``sample`` fraction of pages into one cProfile (or pyinstrument) report.
+
+    cProfile output is a pstats file (``python -m pstats``, snakeviz), pyinstrument
+    output an HTML page.
+    """
+
+    def __init__(self, sample, path, kind='cprofile'):
+        if kind not in ('cprofile', 'pyinstrument'):
+            raise ValueError('profiler must be cprofile or pyinstrument')
+        if kind == 'pyinstrument' and pyinstrument is None:
+            raise ImportError('the pyinstrument profiler needs the pyinstrument package')
+        self.sample = sample
+        self.path = path
+        self.kind = kind
+        self.pages = 0
+        self.profiler = cProfile.Profile() if kind == 'cprofile' else pyinstrument.Profiler()
+
+    def page(self):
+        """Context manager profiling the current page if it is sampled."""
+        if random.random() >= self.sample:
+            return nullcontext()
+        return self._profile()
+
+    @contextmanager
+    def _profile(self):
+        if self.kind == 'cprofile':
+            self.profiler.enable()
+        else:
+            self.profiler.start()
+        try:
+            yield
+        finally:
+            if self.kind == 'cprofile':
+                self.profiler.disable()
+            else:
+                self.profiler.stop()
+            self.pages += 1
+
+    def dump(self):
+        if not self.pages:
+            return
+        if self.kind == 'cprofile':
+            self.profiler.dump_stats(self.path)
+        else:
+            write_atomic(self.path, self.profiler.output_html())
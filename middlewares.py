@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import logging
+from collections import defaultdict
+
+from scrapy.downloadermiddlewares.retry import RetryMiddleware, get_retry_request
+from scrapy.utils.defer import maybe_deferred_to_future
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
+
+from backoff import backoff_delay, retry_after_seconds
+from dsr_stream import response_kind, EMPTY_RESULTS, ERROR
+
+logger = logging.getLogger(__name__)
+
+
+class QueryDataRetryMiddleware(RetryMiddleware):
+    """Retry Power BI querydata POSTs with exponential backoff and jitter.
+
+    Applies to requests carrying a ``chain`` in ``request.meta`` (see
+    ``PowerBISpider.querydata_request``); anything else falls through to the stock
+    RetryMiddleware, which this one replaces in ``DOWNLOADER_MIDDLEWARES``.
+    Retries reuse the original request, so the POST body and its restart
+    token are preserved. Empty ``results`` (captcha) pages are retried too; in-band errors and
+    bodies that aren't JSON are passed on untouched (counted as ``querydata_retry/not_retried/error``),
+    as the spider falls back to a smaller window for those instead.
+
+    Settings:
+        QUERYDATA_RETRY_TIMES         retries per request (default 10, ``max_retry_times`` in meta overrides it)
+        QUERYDATA_RETRY_BACKOFF_BASE  first backoff in seconds (default 1)
+        QUERYDATA_RETRY_BACKOFF_MAX   backoff and Retry-After cap in seconds (default 60)
+        QUERYDATA_RETRY_SHARD_BUDGET  retries per shard for the whole crawl (default 200)
+
+    Stats are kept under ``querydata_retry/``.
+    """
+
+    stats_base_key = 'querydata_retry'
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.querydata_retry_times = settings.getint('QUERYDATA_RETRY_TIMES', 10)
+        self.backoff_base = settings.getfloat('QUERYDATA_RETRY_BACKOFF_BASE', 1.0)
+        self.backoff_max = settings.getfloat('QUERYDATA_RETRY_BACKOFF_MAX', 60.0)
+        self.shard_budget = settings.getint('QUERYDATA_RETRY_SHARD_BUDGET', 200)
+        self.shard_retries = defaultdict(int)
+        self.stats = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        middleware = cls(crawler.settings)
+        middleware.crawler = crawler
+        middleware.stats = crawler.stats
+        return middleware
+
+    async def process_response(self, request, response, spider):
+        if 'chain' not in request.meta or request.meta.get('dont_retry', False):
+            return super().process_response(request, response, spider)
+        if response.status in self.retry_http_codes:
+            reason = f'status_{response.status}'
+        elif response.status != 200:
+            return response
+        else:
+            kind = response_kind(response.body)
+            if kind == ERROR:
+                self.stats.inc_value(f'{self.stats_base_key}/not_retried/error')
+            if kind != EMPTY_RESULTS:
+                return response
+            reason = 'empty_results'
+        return await self.retry(request, reason, spider, response) or response
+
+    async def process_exception(self, request, exception, spider):
+        if 'chain' not in request.meta or request.meta.get('dont_retry', False) \
+                or not isinstance(exception, self.exceptions_to_retry):
+            return super().process_exception(request, exception, spider)
+        return await self.retry(request, exception, spider)
+
+    async def retry(self, request, reason, spider, response=None):
+        shard = request.meta['chain'].get('shard')
+        if self.shard_retries[shard] >= self.shard_budget:
+            self.stats.inc_value(f'{self.stats_base_key}/shard_budget_exhausted')
+            logger.error(f'Retry budget of {self.shard_budget} exhausted for shard {shard}, giving up on {request}')
+            return None
+
+        retry_request = get_retry_request(request, spider=spider, reason=reason,
+                                          max_retry_times=request.meta.get('max_retry_times', self.querydata_retry_times),
+                                          stats_base_key=self.stats_base_key)
+        if retry_request is None:
+            return None
+        self.shard_retries[shard] += 1
+
+        delay = self.backoff(retry_request.meta['retry_times'], response)
+        self.stats.inc_value(f'{self.stats_base_key}/backoff_seconds', delay)
+        logger.info(f'Retrying shard {shard} page {request.meta["chain"].get("page")} in {delay:.1f}s ({reason})')
+        # The wait keeps this request active in the downloader, which also throttles new requests.
+        await maybe_deferred_to_future(deferLater(reactor, delay, lambda: None))
+        return retry_request
+
+    def backoff(self, attempt, response=None):
+        """Exponential backoff with equal jitter, never shorter than the server's Retry-After."""
+        retry_after = self.retry_after(response) if response is not None else None
+        return backoff_delay(attempt, self.backoff_base, self.backoff_max, retry_after)
+
+    @staticmethod
+    def retry_after(response):
+        return retry_after_seconds(response.headers.get('Retry-After'))
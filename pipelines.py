@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+from datetime import datetime
+
+from scrapy.exceptions import NotConfigured
+
+from items import TransactionPage
+
+try:
+    import pyarrow as pa
+    import pyarrow.fs
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is only needed when the columnar export is enabled
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+
+class ColumnarExportPipeline(object):
+    """Buffer transactions into typed columns and write Parquet (or Arrow IPC) files of one row group each.
+
+    Accepts per-row dict items as well as whole ``TransactionPage`` items. The
+    column types come from the spider's ``export_schema`` (field name, type)
+    pairs, where type is one of ``int64``, ``float64``, ``string`` or
+    ``dictionary`` (dictionary-encoded strings).
+
+    Settings:
+        COLUMNAR_EXPORT_URI             base URI, local path or s3://...; the pipeline is off without it
+        COLUMNAR_EXPORT_FORMAT          ``parquet`` (default) or ``arrow``
+        COLUMNAR_EXPORT_ROW_GROUP_SIZE  rows per row group / record batch (default 100000)
+        COLUMNAR_EXPORT_COMPRESSION     codec (default ``zstd``)
+
+    Files go to ``<URI>/<S3_MI7_PATH_ACTIVE_ADS><YYYY-MM-DD>/<spider>-<HHMMSS>-<part>.<format>``.
+    Every row group is closed as its own part file, so what was written survives a crash; spiders
+    with checkpoints (powerbi_spider.PowerBISpider) only advance them once a part is closed.
+    """
+
+    types = {
+        'int64': lambda: pa.int64(),
+        'float64': lambda: pa.float64(),
+        'string': lambda: pa.string(),
+        'dictionary': lambda: pa.dictionary(pa.int32(), pa.string()),
+    }
+
+    def __init__(self, uri, prefix, file_format, row_group_size, compression, stats):
+        self.uri = uri if '://' in uri else os.path.abspath(uri)
+        self.prefix = prefix
+        self.file_format = file_format
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.stats = stats
+        self.rows_written = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        uri = settings.get('COLUMNAR_EXPORT_URI')
+        if not uri:
+            raise NotConfigured
+        if pa is None:
+            raise NotConfigured('COLUMNAR_EXPORT_URI is set but pyarrow is not installed')
+        file_format = settings.get('COLUMNAR_EXPORT_FORMAT', 'parquet')
+        if file_format not in ('parquet', 'arrow'):
+            raise NotConfigured(f'Unknown COLUMNAR_EXPORT_FORMAT {file_format!r}')
+        return cls(uri, settings.get('S3_MI7_PATH_ACTIVE_ADS', ''), file_format,
+                   settings.getint('COLUMNAR_EXPORT_ROW_GROUP_SIZE', 100000),
+                   settings.get('COLUMNAR_EXPORT_COMPRESSION', 'zstd'), crawler.stats)
+
+    def open_spider(self, spider):
+        self.schema = pa.schema([(name, self.types[kind]()) for name, kind in spider.export_schema])
+        self.buffers = {name: [] for name in self.schema.names}
+        self.buffered = 0
+
+        now = datetime.now()
+        self.filesystem, base = pyarrow.fs.FileSystem.from_uri(self.uri)
+        parts = [part.strip('/') for part in (self.prefix, now.strftime('%Y-%m-%d'))]
+        directory = '/'.join([base.rstrip('/')] + [part for part in parts if part])
+        self.filesystem.create_dir(directory, recursive=True)
+        self.path = f"{directory}/{spider.name}-{now:%H%M%S}"
+        self.parts = 0
+        hold_checkpoints = getattr(spider, 'hold_checkpoints', None)
+        if hold_checkpoints is not None:
+            self.rows_written = hold_checkpoints()
+
+    def process_item(self, item, spider):
+        if isinstance(item, TransactionPage):
+            for name, values in item.columns.items():
+                if name in self.buffers:
+                    self.buffers[name].extend(values)
+            self.buffered += len(item)
+        else:
+            for name, values in self.buffers.items():
+                values.append(item.get(name))
+            self.buffered += 1
+        if self.buffered >= self.row_group_size:
+            self.flush()
+        return item
+
+    def flush(self):
+        if not self.buffered:
+            return
+        arrays = []
+        for field in self.schema:
+            values = self.buffers[field.name]
+            if pa.types.is_dictionary(field.type):
+                arrays.append(pa.array(values, type=pa.string()).dictionary_encode())
+            else:
+                arrays.append(pa.array(values, type=field.type))
+        table = pa.Table.from_arrays(arrays, schema=self.schema)
+
+        self.parts += 1
+        path = f'{self.path}-{self.parts:04d}.{self.file_format}'
+        with self.filesystem.open_output_stream(path) as sink:
+            if self.file_format == 'parquet':
+                with pq.ParquetWriter(sink, self.schema, compression=self.compression) as writer:
+                    writer.write_table(table, row_group_size=self.buffered)
+            else:
+                options = pyarrow.ipc.IpcWriteOptions(compression=self.compression)
+                with pyarrow.ipc.new_file(sink, self.schema, options=options) as writer:
+                    for batch in table.to_batches():
+                        writer.write_batch(batch)
+
+        self.stats.inc_value('columnar_export/rows', self.buffered)
+        self.stats.inc_value('columnar_export/row_groups')
+        self.buffers = {name: [] for name in self.schema.names}
+        self.buffered = 0
+        if self.rows_written is not None:
+            self.rows_written()
+
+    def close_spider(self, spider):
+        self.flush()
+        if self.rows_written is not None:
+            self.rows_written(final=True)
+        if self.parts:
+            logger.info(f'Columnar export written to {self.path}-*.{self.file_format} ({self.parts} parts)')
@@ -0,0 +1,622 @@
+# -*- coding: utf-8 -*-
+"""
+Schema-driven Power BI crawl engine, independent of Scrapy.
+
+A report is described by a JSON config (see ``reports/``): resource key,
+model id, entity, the Select columns with their output field names and
+types, ordering and paging. ``ReportCrawl`` turns a config into querydata
+bodies, one RestartToken chain per shard, and decodes each response into
+rows keyed by field. Which columns are dictionary-encoded and where each
+field sits in a response are read from the response itself (the ``S``
+schema of the first DM0 row and ``descriptor.Select``), not hardcoded.
+"""
+import json
+import logging
+import time
+from contextlib import nullcontext
+from datetime import datetime, timedelta, date
+
+from crawl_state import CrawlState
+from dsr_decoder import DM0Decoder
+from dsr_stream import DSRStream
+from items import TransactionPage
+from metrics import PageMetrics
+from semantic_query import column, comparison, date_ranges, QueryBuilder, EQUAL, GREATER_THAN_OR_EQUAL, LESS_THAN
+
+logger = logging.getLogger(__name__)
+
+SOURCE = 'n'
+DIRECTIONS = {'asc': 1, 'desc': 2}
+SHARD_DAYS = {'day': 1, 'week': 7}
+
+
+class ReportConfig(object):
+    """A Power BI report query, loaded from a JSON config."""
+
+    def __init__(self, data):
+        self.data = data
+        self.name = data['name']
+        self.report_url = data['report_url']
+        self.resource_key = data['resource_key']
+        self.model_id = data['model_id']
+        self.entity = data['entity']
+        self.columns = data['columns']
+        self.order_by = data.get('order_by', [])
+        self.fields = [entry['field'] for entry in self.columns]
+        self.output = data.get('output') or self.fields
+        self.window = data.get('window', 500)
+        self.data_volume = data.get('data_volume', 15)
+        # Window sizes and DataVolume values window_size=auto may probe
+        self.window_candidates = data.get('window_candidates') or [self.window]
+        self.data_volume_candidates = data.get('data_volume_candidates') or [self.data_volume]
+        self.id_field = data.get('id_field')
+        self.date_field = data.get('date_field')
+        self.region_field = data.get('region_field')
+        self.stats_prefix = data.get('stats_prefix') or self.name.split('.')[0]
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def property_of(self, field):
+        return self.columns[self.fields.index(field)]['property']
+
+    @property
+    def export_schema(self):
+        """(field, type) pairs in output order, for pipelines.ColumnarExportPipeline."""
+        types = {entry['field']: entry.get('type', 'string') for entry in self.columns}
+        return tuple((field, types[field]) for field in self.output)
+
+    def build_query(self):
+        """The querydata body for this report, without Where or RestartTokens."""
+        select = [{entry.get('kind', 'Column'): column(entry['property'], SOURCE)['Column'], 'Name': entry['name']}
+                  for entry in self.columns]
+        order_by = [{'Direction': DIRECTIONS[entry.get('direction', 'asc')],
+                     'Expression': column(entry['property'], SOURCE)} for entry in self.order_by]
+        semantic_query = {'Version': 2, 'From': [{'Name': SOURCE, 'Entity': self.entity, 'Type': 0}], 'Select': select}
+        if order_by:
+            semantic_query['OrderBy'] = order_by
+        return {
+            'version': '1.0.0',
+            'queries': [{
+                'Query': {'Commands': [{'SemanticQueryDataShapeCommand': {
+                    'Query': semantic_query,
+                    'Binding': {
+                        'Primary': {'Groupings': [{'Projections': list(range(len(self.columns)))}]},
+                        'DataReduction': {'DataVolume': self.data_volume,
+                                          'Primary': {'Window': {'Count': self.window}}},
+                        'Version': 2,
+                    },
+                    'ExecutionMetricsKind': 1,
+                }}]},
+                'QueryId': '',
+            }],
+            'cancelQueries': [],
+            'modelId': self.model_id,
+        }
+
+    def layout(self, descriptor, schema):
+        """Map each field to its column index in a response.
+
+        ``descriptor.Select`` names each schema entry (``G0``, ``M0``..) with its
+        Select name; without a descriptor, columns are assumed in config order.
+        """
+        by_name = {entry['name']: entry['field'] for entry in self.columns}
+        names = {entry.get('Value'): entry.get('Name') for entry in (descriptor or {}).get('Select', [])}
+        layout = {}
+        for index, entry in enumerate(schema or ()):
+            field = by_name.get(names.get(entry.get('N')))
+            if field is None and index < len(self.fields) and not names:
+                field = self.fields[index]
+            if field is not None:
+                layout[field] = index
+        if not layout:
+            layout = {field: index for index, field in enumerate(self.fields)}
+        return layout
+
+
+class WindowTuner(object):
+    """Chooses the DataReduction window size (``Count``) and ``DataVolume`` of a crawl.
+
+    With ``auto``, candidate sizes are probed smallest first on the first page of a chain: a size
+    is accepted while the service returns it in full and rows per second stay within
+    ``tolerance`` of the best so far. A truncated probe is tried once more with the next
+    DataVolume before giving up on that size. During the crawl a truncated or rejected page
+    steps the size down to the next smaller candidate. A ``pinned`` size is never changed.
+    """
+
+    tolerance = 0.9
+
+    def __init__(self, windows, data_volumes, default_window, default_data_volume, auto=False, pinned=None):
+        self.windows = sorted(set(windows) | {default_window})
+        self.data_volumes = sorted(set(data_volumes) | {default_data_volume})
+        self.pinned = pinned
+        self.window = pinned or default_window
+        self.data_volume = default_data_volume
+        self.probing = bool(auto) and not pinned and len(self.windows) > 1
+        self.probe_index = 0
+        self.probe_volume = self.data_volumes.index(default_data_volume)
+        self.accepted = None
+        self.best_rate = 0.0
+        self.results = []
+        if self.probing:
+            self.window = self.windows[0]
+
+    def next_probe(self):
+        """(window, DataVolume) to probe next, or None once the size is chosen."""
+        if not self.probing:
+            return None
+        return self.windows[self.probe_index], self.data_volumes[self.probe_volume]
+
+    def record_probe(self, rows, seconds, truncated=False, failed=False, exhausted=False):
+        """Take the outcome of the current probe; returns the reason probing stopped, if it did."""
+        window, data_volume = self.next_probe()
+        rate = rows / seconds if seconds and not failed else 0.0
+        self.results.append((window, data_volume, rows, rate, 'failed' if failed else 'truncated' if truncated else 'ok'))
+        if failed:
+            return self.settle('failed')
+        if truncated:
+            if self.probe_volume + 1 < len(self.data_volumes):
+                self.probe_volume += 1
+                return None
+            return self.settle('truncated')
+        if self.accepted is not None and rate < self.best_rate * self.tolerance:
+            return self.settle('slower')
+        self.accepted = (window, data_volume)
+        self.best_rate = max(self.best_rate, rate)
+        if exhausted:
+            # The whole range fit in one page; a larger window would not change anything.
+            return self.settle('exhausted')
+        if self.probe_index + 1 >= len(self.windows):
+            return self.settle('largest')
+        self.probe_index += 1
+        return None
+
+    def settle(self, reason):
+        self.probing = False
+        self.window, self.data_volume = self.accepted or (self.windows[0], self.data_volume)
+        return reason
+
+    def can_fall_back(self, window):
+        """True if a page of ``window`` rows could be re-requested with a smaller window."""
+        return not self.pinned and any(candidate < window for candidate in self.windows)
+
+    def fallback(self, window):
+        """Step down from a size that was truncated or rejected; False if there is nothing smaller."""
+        if self.pinned:
+            return False
+        if window > self.window:
+            # Another chain already stepped down below this page's size.
+            return True
+        smaller = [candidate for candidate in self.windows if candidate < window]
+        if not smaller:
+            return False
+        self.window = smaller[-1]
+        return True
+
+
+class PageResult(object):
+    """What one querydata response yielded: items, the next chain (or None) and flags."""
+
+    def __init__(self, has_results, items=(), next_chain=None, end_of_range=False, rows=0, truncated=False,
+                 rejected=False, ids=()):
+        self.has_results = has_results
+        # The service answered with an error instead of a data shape (see ReportCrawl.parse_page)
+        self.rejected = rejected
+        self.items = items
+        self.rows = rows
+        self.truncated = truncated
+        self.next_chain = next_chain
+        self.end_of_range = end_of_range
+        # Ids of the emitted rows, persisted with the checkpoint so resumed runs still dedupe
+        self.ids = ids
+
+
+class ReportCrawl(object):
+    """Crawl state and logic for one report: shards, request bodies and page decoding.
+
+    ``stats`` is anything with Scrapy-style ``inc_value`` and ``max_value``.
+    Dates are compared as the report's 'YYYY/MM/DD...' text. Per-page timings
+    go to ``metrics`` and the ``page/`` stats; set ``profiler`` to a
+    metrics.PageProfiler to profile sampled pages.
+    """
+
+    def __init__(self, config, stats, shard=None, regions=None, start_date=None, end_date=None,
+                 delta_crawl=False, state_path='state.sqlite', yield_pages=False, resume=False, window_size=None):
+        self.config = config
+        self.stats = stats
+        self.query_builder = QueryBuilder(config.build_query())
+        self.date_column = config.property_of(config.date_field) if config.date_field else None
+        self.stats_prefix = config.stats_prefix
+        self.metrics = PageMetrics()
+        self.profiler = None
+
+        # window_size=auto probes the config's window_candidates at the start of the crawl, a number
+        # pins the window; either way truncated or rejected pages fall back to smaller windows
+        # unless the size is pinned.
+        auto = str(window_size).lower() == 'auto'
+        pinned = int(window_size) if window_size and not auto else None
+        self.tuner = WindowTuner(config.window_candidates, config.data_volume_candidates, config.window,
+                                 config.data_volume, auto=auto, pinned=pinned)
+
+        # shard=day|week splits the crawled date range into days or weeks, regions=<name>,<name> into
+        # one chain per region; every shard pages through its own RestartToken chain.
+        if shard and shard not in SHARD_DAYS:
+            raise ValueError(f"shard must be one of {', '.join(SHARD_DAYS)}")
+        self.shard = shard
+        self.regions = [region.strip() for region in regions.split(',') if region.strip()] if regions else []
+        if self.regions and not config.region_field:
+            raise ValueError(f'{config.name} has no region_field to shard on')
+        self.seen_ids = set()
+        self.yield_pages = yield_pages
+        # Shards whose chain has not ended yet (None until chains() runs) and those given up on;
+        # the delta watermark only moves once every chain ended.
+        self.open_chains = None
+        self.failed_chains = set()
+
+        # delta_crawl only fetches rows dated on or after the persisted watermark
+        # (the newest date seen by the last finished run) instead of the previous month.
+        self.delta_crawl = delta_crawl
+        # Every chain is checkpointed after each page; resume continues them from there. Checkpoints
+        # are staged until commit_checkpoints(), called once the rows before them are written out.
+        self.state = CrawlState(state_path)
+        self.pending_checkpoints = {}
+        self.pending_ids = []
+        self.resume = resume
+        if self.delta_crawl:
+            self.watermark_date, self.watermark_ids = self.state.watermark(config.name)
+            if self.watermark_date is None:
+                self.watermark_date = self.target_month()[0].strftime('%Y/%m/%d')
+            self.high_water_date, self.high_water_ids = self.watermark_date, set(self.watermark_ids)
+
+        # start_date/end_date (inclusive) are sent to the server as a Where filter on the date
+        # field; without either the previous month is crawled. Delta crawls start at the watermark.
+        self.start_date = self.parse_date(start_date)
+        self.end_date = self.parse_date(end_date)
+        if self.date_column is None:
+            self.start_date = self.end_date = None
+        elif self.start_date is None and self.end_date is None and not self.delta_crawl:
+            self.start_date, self.end_date = self.target_month()
+        if self.delta_crawl:
+            self.lower_bound = self.watermark_date
+        else:
+            self.lower_bound = self.start_date.strftime('%Y/%m/%d') if self.start_date else None
+        self.upper_bound = self.end_date.strftime('%Y/%m/%d') if self.end_date else None
+        if self.shard and self.lower_bound is None:
+            raise ValueError('shard needs a start_date to split the date range')
+
+    @staticmethod
+    def target_month():
+        """First and last day of the month being crawled (the previous month)."""
+        last = date.today().replace(day=1) - timedelta(days=1)
+        return last.replace(day=1), last
+
+    @staticmethod
+    def parse_date(value):
+        if not value or isinstance(value, date):
+            return value or None
+        return datetime.strptime(value.replace('/', '-'), '%Y-%m-%d').date()
+
+    def date_conditions(self, lower, upper):
+        """Where conditions for ``lower <= date < upper + 1 day`` (either bound optional).
+
+        The column holds 'YYYY/MM/DD...' text, so bounds are compared as strings and the upper
+        bound is exclusive on the next day to keep any time suffix on the last day.
+        """
+        conditions = []
+        if lower:
+            conditions.append(comparison(self.date_column, GREATER_THAN_OR_EQUAL, lower))
+        if upper:
+            next_day = self.parse_date(upper) + timedelta(days=1)
+            conditions.append(comparison(self.date_column, LESS_THAN, next_day.strftime('%Y/%m/%d')))
+        return conditions
+
+    def shards(self):
+        """Yield (shard name, Where conditions, inclusive upper date or None), one per RestartToken chain."""
+        date_shards = [(None, self.date_conditions(self.lower_bound, self.upper_bound), self.upper_bound)]
+        if self.shard:
+            first_day = self.parse_date(self.lower_bound[:10])
+            last_day = self.end_date or date.today()
+            date_shards = [
+                (f"{lower:%Y/%m/%d}-{upper:%Y/%m/%d}",
+                 self.date_conditions(max(lower.strftime('%Y/%m/%d'), self.lower_bound), upper.strftime('%Y/%m/%d')),
+                 upper.strftime('%Y/%m/%d'))
+                for lower, upper in date_ranges(first_day, last_day, SHARD_DAYS[self.shard])
+            ]
+        region_shards = [(region, [comparison(self.config.property_of(self.config.region_field), EQUAL, region)])
+                         for region in self.regions] or [(None, [])]
+
+        for date_name, date_conditions, upper in date_shards:
+            for region_name, region_conditions in region_shards:
+                name = '|'.join(filter(None, [date_name, region_name])) or 'all'
+                yield name, date_conditions + region_conditions, upper
+
+    @staticmethod
+    def is_closed(upper):
+        """True if a date range ending on ``upper`` lies entirely before the current month."""
+        return bool(upper) and upper[:10] < date.today().replace(day=1).strftime('%Y/%m/%d')
+
+    def chains(self):
+        """The starting state of every shard's RestartToken chain.
+
+        ``closed`` marks chains whose rows can no longer change (see httpcache.QueryDataCacheStorage).
+        With ``resume``, chains continue from their checkpoint and finished ones are left out;
+        otherwise the checkpoints of the previous run are dropped.
+        """
+        chains = [{'shard': shard, 'where': self.query_builder.where(conditions), 'restart_token': None, 'page': 0,
+                   'rows': 0, 'closed': self.is_closed(upper)}
+                  for shard, conditions, upper in self.shards()]
+        if not self.tuner.probing:
+            self.chosen('pinned' if self.tuner.pinned else 'configured')
+        if not self.resume:
+            self.state.clear_checkpoints(self.config.name)
+            self.open_chains = {chain['shard'] for chain in chains}
+            return chains
+
+        checkpoints = self.state.checkpoints(self.config.name)
+        # Rows emitted before the checkpoints, so overlapping shards don't emit them again.
+        self.seen_ids = self.state.seen_ids(self.config.name)
+        resumed = []
+        for chain in chains:
+            # The Where fragment is part of the key, so checkpoints of another date range don't apply.
+            checkpoint = checkpoints.get((chain['shard'], chain['where']))
+            if checkpoint is None:
+                resumed.append(chain)
+                continue
+            if self.delta_crawl and checkpoint['high_water_date']:
+                for row_id in checkpoint['high_water_ids']:
+                    self.track_high_water(checkpoint['high_water_date'], row_id)
+            if checkpoint['done']:
+                self.stats.inc_value(f'{self.stats_prefix}/resumed_done_chains')
+                continue
+            self.stats.inc_value(f'{self.stats_prefix}/resumed_chains')
+            resumed.append(dict(chain, restart_token=checkpoint['restart_token'], page=checkpoint['page'],
+                                rows=checkpoint['rows']))
+        logger.info(f'Resuming {len(resumed)} of {len(chains)} chains from {self.state.path}')
+        self.open_chains = {chain['shard'] for chain in resumed}
+        return resumed
+
+    def sized(self, chain):
+        """``chain`` with the current window size and DataVolume; probes keep their own."""
+        if chain.get('probe'):
+            return chain
+        return dict(chain, window=self.tuner.window, data_volume=self.tuner.data_volume)
+
+    def body(self, chain):
+        return self.query_builder.body(chain['where'], chain['restart_token'], chain.get('window'),
+                                       chain.get('data_volume'))
+
+    def probe_chain(self, chain):
+        """A probe of the next candidate window on the first page of ``chain``, or None when done."""
+        probe = self.tuner.next_probe()
+        if probe is None:
+            return None
+        window, data_volume = probe
+        self.stats.inc_value('window/probes')
+        return dict(chain, restart_token=None, page=0, window=window, data_volume=data_volume, probe=True)
+
+    def record_probe(self, body, chain, seconds):
+        """Feed a probe response (``body`` None if it failed) to the tuner."""
+        rows, truncated, exhausted = 0, False, False
+        failed = body is None
+        if not failed:
+            try:
+                stream = DSRStream(body)
+                failed = not stream.has_results
+                if not failed:
+                    rows = sum(1 for _ in stream.rows())
+                    truncated = stream.restart_token is not None and rows < chain['window']
+                    exhausted = stream.restart_token is None
+            except (KeyError, ValueError) as e:
+                logger.info(f"Window {chain['window']} rejected: {e!r}")
+                rows, truncated, exhausted, failed = 0, False, False, True
+        reason = self.tuner.record_probe(rows, seconds, truncated, failed, exhausted)
+        window, data_volume, rows, rate, outcome = self.tuner.results[-1]
+        self.stats.set_value(f'window/probe/{window}x{data_volume}', f'{outcome} {rate:.0f} rows/s')
+        if reason is not None:
+            self.chosen(f'probing stopped ({reason})')
+
+    def chosen(self, why):
+        self.stats.set_value('window/chosen', self.tuner.window)
+        self.stats.set_value('window/data_volume', self.tuner.data_volume)
+        logger.info(f'Window size {self.tuner.window} (DataVolume {self.tuner.data_volume}): {why}')
+
+    def fallback(self, chain, reason):
+        """``chain`` to re-request with a smaller window after a truncated or failed page, or None."""
+        if chain.get('probe') or not chain.get('window') or not self.tuner.fallback(chain['window']):
+            return None
+        self.stats.inc_value('window/fallbacks')
+        self.stats.inc_value(f'window/fallback_reason/{reason}')
+        self.chosen(f"fallback from {chain['window']} ({reason})")
+        return self.sized(chain)
+
+    def observe(self, name, value):
+        """Record one page's ``value`` for metric ``name`` (see metrics.PAGE_HISTOGRAMS)."""
+        self.metrics.observe(name, value)
+        self.stats.inc_value(f'page/{name}/sum', value)
+        self.stats.max_value(f'page/{name}/max', value)
+
+    def parse_page(self, body, chain):
+        """Decode one querydata response of ``chain`` into a PageResult."""
+        self.observe('response_bytes', len(body))
+        with self.profiler.page() if self.profiler else nullcontext():
+            return self._parse_page(body, chain)
+
+    def _parse_page(self, body, chain):
+        clock = time.perf_counter
+        started = clock()
+        try:
+            stream = DSRStream(body)
+            if not stream.has_results and stream.empty_results:
+                return PageResult(False)
+            if not stream.has_results:
+                raise KeyError('querydata response has no results')
+            # Streams DM0 rows out of results[0].result.data.dsr.DS[0] in a single pass, collecting
+            # ValueDicts and RT on the way; dictionary columns come from the first row's schema.
+            # Scanning the JSON and expanding rows interleave, so the time spent in the scanner is
+            # counted as parse time and the rest as decode time.
+            parse_time = [clock() - started]
+            started = clock()
+            decoder = DM0Decoder()
+            decoder.feed_many(self.timed(stream.rows(), parse_time))
+            columns = decoder.finish(stream.value_dicts)
+        except (KeyError, ValueError) as e:
+            # An in-band error (dsr.DataShapes with odata.error) or a body that isn't JSON, as
+            # the service answers windows it won't serve: the caller falls back to a smaller one.
+            logger.warning(f"Page {chain['page']} of shard {chain['shard']} rejected: {e!r}")
+            self.stats.inc_value(f'{self.stats_prefix}/rejected_pages')
+            return PageResult(False, rejected=True)
+        layout = self.config.layout(stream.descriptor, decoder.schema)
+        decode_time = clock() - started - parse_time[0]
+        self.observe('parse_seconds', parse_time[0])
+        self.observe('decode_seconds', decode_time)
+
+        kept, ids, end_of_range = self.filter_rows(columns, layout)
+        items = list(self.rows(columns, layout, kept, chain))
+        next_chain = None
+        if stream.restart_token is not None and not end_of_range:
+            next_chain = dict(chain, restart_token=stream.restart_token, page=chain['page'] + 1,
+                              rows=chain.get('rows', 0) + len(kept))
+        # A short page that still has a restart token was cut by the service; the token still
+        # continues after its last row, so only the window needs to shrink.
+        n_rows = len(columns[0]) if columns else 0
+        truncated = stream.restart_token is not None and chain.get('window') and n_rows < chain['window']
+        if truncated:
+            self.fallback(chain, 'truncated')
+        self.observe('rows', len(kept))
+        return PageResult(True, items, next_chain, end_of_range, len(kept), bool(truncated), ids=ids)
+
+    @staticmethod
+    def timed(rows, elapsed):
+        """Pass ``rows`` through, adding the time spent producing them to ``elapsed[0]``."""
+        clock = time.perf_counter
+        while True:
+            started = clock()
+            try:
+                row = next(rows)
+            except StopIteration:
+                elapsed[0] += clock() - started
+                return
+            elapsed[0] += clock() - started
+            yield row
+
+    def checkpoint(self, chain, page):
+        """Stage where ``chain`` continues once the items of ``page`` (a PageResult) were handed over."""
+        done = page.next_chain is None
+        self.pending_checkpoints[chain['shard']] = {
+            'shard': chain['shard'],
+            'query': chain['where'],
+            'restart_token': None if done else page.next_chain['restart_token'],
+            'page': chain['page'] + 1,
+            'rows': chain.get('rows', 0) + page.rows,
+            'done': done,
+            'high_water_date': self.high_water_date if self.delta_crawl else None,
+            'high_water_ids': set(self.high_water_ids) if self.delta_crawl else (),
+        }
+        self.pending_ids.extend(page.ids)
+        if done:
+            self.open_chains.discard(chain['shard'])
+
+    def commit_checkpoints(self):
+        """Persist the staged checkpoints; call once the rows of every staged page are durably written."""
+        if not self.pending_checkpoints:
+            return
+        self.state.set_checkpoints(self.config.name, self.pending_checkpoints.values(), self.pending_ids)
+        self.stats.inc_value(f'{self.stats_prefix}/checkpoint_commits')
+        self.pending_checkpoints = {}
+        self.pending_ids = []
+
+    def fail(self, chain, reason):
+        """Give up on ``chain``: it stays open, so a delta crawl keeps its old watermark."""
+        self.failed_chains.add(chain['shard'])
+        self.stats.inc_value(f'{self.stats_prefix}/failed_chains')
+        self.stats.inc_value(f'{self.stats_prefix}/failed_chain_reason/{reason}')
+
+    @property
+    def complete(self):
+        """True once every chain ran to its last page or past the date range."""
+        return self.open_chains is not None and not self.open_chains
+
+    def filter_rows(self, columns, layout):
+        """Indexes of the rows to emit, their ids and whether the chain went past the lower date bound."""
+        n_rows = len(columns[0]) if columns else 0
+        if not n_rows:
+            # An empty range: no schema came back, so the layout doesn't index into any columns.
+            return [], [], False
+        dates = columns[layout[self.config.date_field]] if self.config.date_field in layout else [''] * n_rows
+        ids = columns[layout[self.config.id_field]] if self.config.id_field in layout else [None] * n_rows
+        kept = []
+        kept_ids = []
+        skipped = dict.fromkeys(('below_range', 'above_range', 'watermark', 'duplicate'), 0)
+        end_of_range = False
+        for index, (row_date, row_id) in enumerate(zip(dates, ids)):
+            # The server already filters on the date range; these checks only guard against
+            # rows outside it. Rows are sorted newest first, so the lower bound ends the chain.
+            row_date = row_date or ''
+            if self.lower_bound and row_date < self.lower_bound:
+                skipped['below_range'] = n_rows - index
+                end_of_range = True
+                break
+            if self.upper_bound and row_date[:10] > self.upper_bound:
+                skipped['above_range'] += 1
+                continue
+            if self.delta_crawl and row_date == self.watermark_date and row_id in self.watermark_ids:
+                skipped['watermark'] += 1
+                continue
+
+            if row_id is not None:
+                if row_id in self.seen_ids:
+                    # Shards can overlap on their boundaries; keep the first copy.
+                    skipped['duplicate'] += 1
+                    continue
+                self.seen_ids.add(row_id)
+                kept_ids.append(row_id)
+            if self.delta_crawl:
+                self.track_high_water(row_date, row_id)
+            kept.append(index)
+
+        self.stats.inc_value(f'{self.stats_prefix}/rows_received', n_rows)
+        for reason, count in skipped.items():
+            if count:
+                self.stats.inc_value(f'{self.stats_prefix}/rows_skipped/{reason}', count)
+        if skipped['duplicate']:
+            self.stats.inc_value(f'{self.stats_prefix}/duplicate_transactions', skipped['duplicate'])
+        return kept, kept_ids, end_of_range
+
+    def rows(self, columns, layout, kept, chain):
+        """Yield the rows at ``kept`` as dicts in output order, or as one TransactionPage with yield_pages."""
+        self.stats.inc_value(f'{self.stats_prefix}/transactions', len(kept))
+        output = [(field, layout.get(field)) for field in self.config.output]
+        if self.yield_pages:
+            if kept:
+                yield TransactionPage(
+                    columns={field: [columns[index][i] for i in kept] if index is not None else [None] * len(kept)
+                             for field, index in output},
+                    shard=chain['shard'], page=chain['page'])
+            return
+        for i in kept:
+            yield {field: columns[index][i] if index is not None else None for field, index in output}
+
+    def track_high_water(self, row_date, row_id):
+        if row_date > self.high_water_date:
+            self.high_water_date, self.high_water_ids = row_date, {row_id}
+        elif row_date == self.high_water_date:
+            self.high_water_ids.add(row_id)
+
+    def close(self, finished):
+        # Rows arrive newest first, so an interrupted run, or one that gave up on a chain, may have
+        # skipped older rows above the old watermark: only move it forward once every chain ended
+        # and all of its rows were written out.
+        if self.pending_checkpoints:
+            logger.warning(f'{len(self.pending_checkpoints)} checkpoints not committed: their rows were not written out')
+        if self.delta_crawl and finished and self.complete and not self.pending_checkpoints:
+            self.state.set_watermark(self.config.name, self.high_water_date, self.high_water_ids)
+            logger.info(f'Delta watermark saved: {self.high_water_date} ({len(self.high_water_ids)} ids)')
+        elif self.delta_crawl and self.pending_checkpoints:
+            logger.warning(f'Delta watermark kept at {self.watermark_date}: rows not written out')
+        elif self.delta_crawl:
+            open_chains = sorted(self.open_chains or ())
+            logger.warning(f'Delta watermark kept at {self.watermark_date}: {len(open_chains)} chains did not end'
+                           f" ({', '.join(open_chains[:5])}{', ...' if len(open_chains) > 5 else ''})")
+        self.state.close()
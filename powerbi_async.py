@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio crawl of a Power BI report, without Scrapy or the Twisted reactor.
+
+Meant for small scheduled runs (delta crawls) where Scrapy start-up would
+dominate. Query construction, RestartToken paging, row decoding, dedupe,
+checkpoints and window tuning are the same ``powerbi.ReportCrawl`` the
+spider uses, so the emitted transaction dicts are identical. Requires
+``aiohttp``; every proxy gets its own pooled keep-alive session.
+
+    python powerbi_async.py -a delta_crawl=true -o transactions.jl
+    python powerbi_async.py --report reports/moj_transactions.json -a start_date=2024-01-01 --proxy http://...
+"""
+import argparse
+import asyncio
+import dataclasses
+import json
+import logging
+import os
+import sys
+import time
+import zlib
+
+from backoff import backoff_delay, retry_after_seconds
+from dsr_stream import response_kind, EMPTY_RESULTS, ERROR
+from powerbi import ReportConfig, ReportCrawl
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPORT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reports', 'moj_transactions.json')
+RETRY_HTTP_CODES = (400, 429, 403, 408, 500, 502, 503, 504, 522, 523)
+_DONE = object()
+
+
+class Stats(object):
+    """The part of Scrapy's stats collector interface ReportCrawl uses, backed by a dict."""
+
+    def __init__(self):
+        self._stats = {}
+
+    def get_value(self, key, default=None):
+        return self._stats.get(key, default)
+
+    def set_value(self, key, value):
+        self._stats[key] = value
+
+    def inc_value(self, key, count=1, start=0):
+        self._stats[key] = self._stats.get(key, start) + count
+
+    def max_value(self, key, value):
+        self._stats[key] = max(self._stats.get(key, value), value)
+
+    def get_stats(self):
+        return self._stats
+
+
+class AsyncReportCrawler(object):
+    """Crawl every chain of a ReportCrawl with ``concurrency`` requests in flight.
+
+    Chains are spread over ``proxies`` (None for a direct connection) by shard, each
+    proxy with its own keep-alive connection pool. Retries follow QueryDataRetryMiddleware:
+    HTTP errors, timeouts and empty-results (captcha) pages are retried with exponential
+    backoff and Retry-After, counted under ``querydata_retry/``. In-band errors are returned
+    as they are, for the window fallback.
+    """
+
+    def __init__(self, report, url=None, concurrency=4, proxies=None, delay=0.05, retry_times=10,
+                 backoff_base=1.0, backoff_max=60.0, timeout=180.0):
+        if aiohttp is None:
+            raise ImportError('the asyncio crawler needs aiohttp (pip install aiohttp)')
+        self.report = report
+        self.url = url or report.config.report_url
+        self.headers = {
+            'X-PowerBI-ResourceKey': report.config.resource_key,
+            'Content-Type': 'application/json'
+        }
+        self.concurrency = concurrency
+        self.proxies = list(proxies or [None])
+        self.delay = delay
+        self.retry_times = retry_times
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.sessions = {}
+        self.stats = report.stats
+
+    def session(self, chain):
+        proxy = self.proxies[zlib.crc32(str(chain['shard']).encode('utf-8')) % len(self.proxies)]
+        session = self.sessions.get(proxy)
+        if session is None:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+            session = self.sessions[proxy] = aiohttp.ClientSession(
+                connector=connector, headers=self.headers, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return session, proxy
+
+    async def fetch(self, chain, retry_times=None):
+        """POST the page of a sized ``chain``, with retries; returns (body or None, seconds of the last attempt)."""
+        body = self.report.body(chain).encode('utf-8')
+        session, proxy = self.session(chain)
+        retry_times = self.retry_times if retry_times is None else retry_times
+        attempt = 0
+        while True:
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            started = time.perf_counter()
+            retry_after = None
+            try:
+                async with session.post(self.url, data=body, proxy=proxy) as response:
+                    content = await response.read()
+                    status = response.status
+                    retry_after = retry_after_seconds(response.headers.get('Retry-After'))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                reason = type(e).__name__
+            else:
+                self.stats.inc_value('downloader/response_count')
+                self.stats.inc_value(f'downloader/response_status_count/{status}')
+                kind = response_kind(content) if status == 200 else None
+                if status in RETRY_HTTP_CODES:
+                    reason = f'status_{status}'
+                elif kind == EMPTY_RESULTS:
+                    reason = 'empty_results'
+                else:
+                    if kind == ERROR:
+                        self.stats.inc_value('querydata_retry/not_retried/error')
+                    return (content if status == 200 else None), time.perf_counter() - started
+            latency = time.perf_counter() - started
+
+            attempt += 1
+            if attempt > retry_times:
+                self.stats.inc_value('querydata_retry/max_reached')
+                logger.error(f"Gave up retrying shard {chain['shard']} page {chain['page']} ({reason})")
+                return None, latency
+            self.stats.inc_value('querydata_retry/count')
+            self.stats.inc_value(f'querydata_retry/reason_count/{reason}')
+            delay = backoff_delay(attempt, self.backoff_base, self.backoff_max, retry_after)
+            self.stats.inc_value('querydata_retry/backoff_seconds', delay)
+            logger.info(f"Retrying shard {chain['shard']} page {chain['page']} in {delay:.1f}s ({reason})")
+            await asyncio.sleep(delay)
+
+    async def pages(self):
+        """Yield the items (transaction dicts or a TransactionPage) of each page as it comes in.
+
+        A page's checkpoint is staged when the next page is asked for, so the caller commits
+        them (ReportCrawl.commit_checkpoints) once what it was given is written out.
+        """
+        chains = self.report.chains()
+        try:
+            if chains:
+                await self.probe(chains[0])
+            queue = asyncio.Queue()
+            results = asyncio.Queue(maxsize=self.concurrency * 4)
+            for chain in chains:
+                queue.put_nowait(chain)
+            workers = [asyncio.create_task(self.worker(queue, results)) for _ in range(self.concurrency)]
+            done = asyncio.create_task(self.drain(queue, results))
+            try:
+                while True:
+                    result = await results.get()
+                    if result is _DONE:
+                        break
+                    chain, page = result
+                    yield page.items
+                    self.report.checkpoint(chain, page)
+            finally:
+                for task in workers + [done]:
+                    task.cancel()
+        finally:
+            for session in self.sessions.values():
+                await session.close()
+
+    async def probe(self, chain):
+        # Window size probes run one at a time on the first chain before the crawl starts.
+        while True:
+            probe = self.report.probe_chain(chain)
+            if probe is None:
+                return
+            body, seconds = await self.fetch(probe, retry_times=1)
+            if body is not None:
+                self.report.observe('download_latency_seconds', seconds)
+            self.report.record_probe(body, probe, seconds)
+
+    @staticmethod
+    async def drain(queue, results):
+        await queue.join()
+        await results.put(_DONE)
+
+    async def worker(self, queue, results):
+        while True:
+            chain = await queue.get()
+            try:
+                next_chain = await self.crawl_page(chain, results)
+                if next_chain is not None:
+                    queue.put_nowait(next_chain)
+            except Exception:
+                logger.exception(f"Page {chain['page']} of shard {chain['shard']} failed")
+                self.report.fail(chain, 'exception')
+            finally:
+                queue.task_done()
+
+    async def crawl_page(self, chain, results):
+        """Fetch and decode one page, hand it over and return the chain's next page, if any."""
+        # The window can shrink while this page is in flight, so it is fixed here for the whole page.
+        chain = self.report.sized(chain)
+        body, seconds = await self.fetch(chain)
+        if body is None:
+            return self.fail(chain, 'error')
+        self.report.observe('download_latency_seconds', seconds)
+        page = self.report.parse_page(body, chain)
+        if not page.has_results:
+            return self.fail(chain, 'rejected' if page.rejected else 'empty_results')
+
+        await results.put((chain, page))
+        if page.end_of_range:
+            logger.info('End of date range.')
+        elif page.next_chain is None:
+            logger.info('No Return Token')
+        return page.next_chain
+
+    def fail(self, chain, reason):
+        """``chain`` re-sized to a smaller window, or None after giving up on it."""
+        retry = self.report.fallback(chain, reason)
+        if retry is None:
+            logger.error(f"Giving up on shard {chain['shard']} page {chain['page']} ({reason})")
+            self.report.fail(chain, reason)
+        return retry
+
+
+def as_json(item):
+    if dataclasses.is_dataclass(item):
+        item = dataclasses.asdict(item)
+    return json.dumps(item, ensure_ascii=False, default=str)
+
+
+async def run(args):
+    report_args = dict(arg.split('=', 1) for arg in args.report_args)
+    url = report_args.pop('report_url', None)
+    for flag in ('delta_crawl', 'yield_pages', 'resume'):
+        if flag in report_args:
+            report_args[flag] = report_args[flag].lower() in ('1', 'true', 'yes')
+    report_args.setdefault('state_path', args.state_path)
+
+    stats = Stats()
+    report = ReportCrawl(ReportConfig.load(args.report), stats, **report_args)
+    crawler = AsyncReportCrawler(report, url=url, concurrency=args.concurrency, proxies=args.proxy,
+                                 delay=args.delay, retry_times=args.retry_times)
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    started = time.perf_counter()
+    finished = False
+    try:
+        async for items in crawler.pages():
+            for item in items:
+                if stats.get_value('first_item_seconds') is None:
+                    stats.set_value('first_item_seconds', round(time.perf_counter() - started, 4))
+                output.write(as_json(item) + '\n')
+                stats.inc_value('item_scraped_count')
+            output.flush()
+            report.commit_checkpoints()
+        finished = True
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        # Only pages already written out have their checkpoint staged.
+        report.commit_checkpoints()
+        report.close(finished)
+        stats.set_value('elapsed_time_seconds', round(time.perf_counter() - started, 4))
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--report', default=DEFAULT_REPORT, help='report config (default %(default)s)')
+    parser.add_argument('-a', dest='report_args', action='append', default=[], metavar='NAME=VALUE',
+                        help='crawl argument, as for the spider (start_date, shard, delta_crawl, report_url, ...)')
+    parser.add_argument('-o', '--output', help='JSON lines output file (default stdout)')
+    parser.add_argument('--state-path', default='moj_state.sqlite', help='checkpoints and watermark')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--proxy', action='append', help='proxy URL, repeat to spread shards over several')
+    parser.add_argument('--delay', type=float, default=0.05, help='seconds before each request')
+    parser.add_argument('--retry-times', type=int, default=10)
+    parser.add_argument('--stats', action='store_true', help='print the crawl stats to stderr')
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level, format='%(asctime)s [%(name)s] %(levelname)s: %(message)s')
+
+    stats = asyncio.run(run(args))
+    if args.stats:
+        json.dump(stats.get_stats(), sys.stderr, indent=2, sort_keys=True, default=str)
+        sys.stderr.write('\n')
+
+
+if __name__ == '__main__':
+    main()
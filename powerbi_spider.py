@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+import logging
+import traceback
+from urllib.parse import urlsplit
+
+import scrapy.spiders
+from scrapy import signals
+
+from metrics import PageProfiler
+from powerbi import ReportConfig, ReportCrawl
+
+logger = logging.getLogger(__name__)
+
+
+def as_bool(value):
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+class PowerBISpider(scrapy.Spider):
+    """Crawls a public Power BI report described by a JSON config (see reports/).
+
+    Subclasses set ``name`` and ``report_config``; the query, output fields,
+    shards and paging all come from the config through powerbi.ReportCrawl.
+    """
+
+    # Path of the report config
+    report_config = None
+
+    custom_settings = {
+        'DOWNLOAD_DELAY': 0.05,
+        'RETRY_HTTP_CODES': [400, 429, 403, 408, 500, 502, 503, 504, 522, 523],
+        # Retries (HTTP errors and empty-results captcha pages) with backoff, see middlewares.py
+        'DOWNLOADER_MIDDLEWARES': {
+            'scrapy.downloadermiddlewares.retry.RetryMiddleware': None,
+            'middlewares.QueryDataRetryMiddleware': 550,
+        },
+        # Adaptive in-flight window and delay per slot, starting from DOWNLOAD_DELAY, and an OpenMetrics
+        # dump of the stats when QUERYDATA_METRICS_PATH is set, see extensions.py
+        'EXTENSIONS': {
+            'extensions.QueryDataAIMDThrottle': 0,
+            'extensions.QueryDataMetricsExport': 0,
+        },
+        'QUERYDATA_AIMD_ENABLED': True,
+        # Parquet/Arrow export, active when COLUMNAR_EXPORT_URI is set, see pipelines.py
+        'ITEM_PIPELINES': {
+            'pipelines.ColumnarExportPipeline': 300,
+        },
+        # Compressed on-disk cache of querydata pages, active with HTTPCACHE_ENABLED=True, see httpcache.py
+        'HTTPCACHE_POLICY': 'httpcache.QueryDataCachePolicy',
+        'HTTPCACHE_STORAGE': 'httpcache.QueryDataCacheStorage',
+    }
+
+    def __init__(self, shard=None, regions=None, delta_crawl=False, state_path=None, start_date=None, end_date=None,
+                 report_url=None, yield_pages=False, resume=False, window_size=None, report_config=None, *args,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        # report_config=<path> crawls another report with the same spider
+        self.config = ReportConfig.load(report_config or self.report_config)
+        self.delta_crawl = as_bool(delta_crawl)
+        # yield_pages=true yields one TransactionPage (columns) per response instead of one dict per row
+        self.yield_pages = as_bool(yield_pages)
+        self.pending_chains = []
+        # Checkpoints only advance once the rows before them are written out: after every page,
+        # unless a buffering pipeline holds them (see hold_checkpoints) or a feed export is only
+        # stored when the spider closes (anything but plain local files).
+        self.checkpoint_holds = 0
+        self.feeds_open = False
+        self.feeds_incremental = True
+        self.close_reason = None
+        # Stats are attached once the spider is opened
+        self.report = ReportCrawl(self.config, None, shard=shard, regions=regions, start_date=start_date,
+                                  end_date=end_date, delta_crawl=self.delta_crawl,
+                                  state_path=state_path or f'{self.name}_state.sqlite', yield_pages=self.yield_pages,
+                                  resume=as_bool(resume), window_size=window_size)
+        # report_url can point the spider at a local replay server (benchmarks/replay_server.py)
+        self.report_url = report_url or self.config.report_url
+        self.headers = {
+            'X-PowerBI-ResourceKey': self.config.resource_key,
+            'Content-Type': 'application/json'
+        }
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(spider.feeds_stored, signal=signals.feed_exporter_closed)
+        return spider
+
+    def spider_opened(self, spider):
+        self.report.stats = self.crawler.stats
+        feeds = self.crawler.settings.getdict('FEEDS')
+        self.feeds_open = bool(feeds)
+        self.feeds_incremental = all(
+            urlsplit(str(uri)).scheme in ('', 'file') and not (options or {}).get('postprocessing')
+            for uri, options in feeds.items())
+        # QUERYDATA_PROFILE_SAMPLE=<fraction> profiles that share of pages into QUERYDATA_PROFILE_PATH
+        # with QUERYDATA_PROFILER (cprofile, the default, or pyinstrument)
+        settings = self.crawler.settings
+        sample = settings.getfloat('QUERYDATA_PROFILE_SAMPLE', 0.0)
+        if sample > 0:
+            kind = settings.get('QUERYDATA_PROFILER', 'cprofile')
+            path = settings.get('QUERYDATA_PROFILE_PATH') or \
+                f"{self.name}.{'prof' if kind == 'cprofile' else 'html'}"
+            self.report.profiler = PageProfiler(sample, path, kind)
+
+    @property
+    def export_schema(self):
+        # Column types for pipelines.ColumnarExportPipeline
+        return self.config.export_schema
+
+    def querydata_request(self, chain):
+        """POST for the next page of ``chain``; the chain state travels in request.meta, never on the spider."""
+        chain = self.report.sized(chain)
+        meta = {'chain': chain}
+        if chain.get('probe'):
+            # Probes report failures back to the tuner instead of retrying at length.
+            meta.update(max_retry_times=1, handle_httpstatus_all=True)
+        elif chain['window'] > self.config.window and self.report.tuner.can_fall_back(chain['window']):
+            # A window above the configured one may be what the service rejects: fall back soon.
+            # A pinned window never falls back, so it keeps the full retry budget.
+            meta['max_retry_times'] = 2
+        return scrapy.Request(method='POST', url=self.report_url, callback=self.parse, errback=self.querydata_failed,
+                              headers=self.headers, body=self.report.body(chain), meta=meta, dont_filter=True)
+
+    def start_requests(self):
+        try:
+            self.pending_chains = self.report.chains()
+            yield from self.start_chains()
+
+        except Exception as e:
+            logger.error(f'start_requests  \n :{traceback.format_exc()}')
+
+    def start_chains(self):
+        """Requests for the next window probe, or for every chain once the window size is chosen."""
+        if self.pending_chains:
+            probe = self.report.probe_chain(self.pending_chains[0])
+            if probe is not None:
+                yield self.querydata_request(probe)
+                return
+        chains, self.pending_chains = self.pending_chains, []
+        for chain in chains:
+            yield self.querydata_request(chain)
+
+    def parse(self, response):
+        chain = response.meta['chain']
+        try:
+            latency = response.meta.get('download_latency')
+            if latency is not None and 'cached' not in response.flags:
+                self.report.observe('download_latency_seconds', latency)
+            if chain.get('probe'):
+                body = response.body if response.status == 200 else None
+                self.report.record_probe(body, chain, latency or 0.0)
+                yield from self.start_chains()
+                return
+
+            page = self.report.parse_page(response.body, chain)
+            if not page.has_results:
+                # QueryDataRetryMiddleware already retried this page with backoff.
+                reason = 'rejected' if page.rejected else 'empty_results'
+                retry = self.report.fallback(chain, reason)
+                if retry is not None:
+                    yield self.querydata_request(retry)
+                    return
+                if page.rejected:
+                    logger.error(f"Giving up on shard {chain['shard']} page {chain['page']}: rejected")
+                else:
+                    logger.info(
+                        f"******* MAX RETRY ON CAPTCHA - Parse On {response.url} - shard {chain['shard']} page {chain['page']}")
+                self.report.fail(chain, reason)
+                return
+
+            yield from page.items
+            self.report.checkpoint(chain, page)
+            if not self.checkpoint_holds:
+                self.commit_checkpoints()
+            if page.end_of_range:
+                logger.info('End of date range.')
+            elif page.next_chain is not None:
+                yield self.querydata_request(page.next_chain)
+            else:
+                logger.info('No Return Token')
+
+        except Exception as e:
+            logger.error(f'Parse && url is {response.url} \n :{traceback.format_exc()}')
+            self.report.fail(chain, 'exception')
+
+    def querydata_failed(self, failure):
+        """Errback for pages that failed after retries: try a smaller window before giving up on the chain."""
+        chain = failure.request.meta['chain']
+        if chain.get('probe'):
+            self.report.record_probe(None, chain, 0.0)
+            yield from self.start_chains()
+            return
+        retry = self.report.fallback(chain, 'error')
+        if retry is not None:
+            yield self.querydata_request(retry)
+            return
+        logger.error(f"Giving up on shard {chain['shard']} page {chain['page']}: {failure.value!r}")
+        self.report.fail(chain, 'error')
+
+    def hold_checkpoints(self):
+        """For item pipelines that buffer rows (pipelines.ColumnarExportPipeline).
+
+        Checkpoints then only advance when the pipeline calls the returned ``rows_written`` after
+        writing out every row handed to it so far; ``rows_written(final=True)`` releases the hold.
+        """
+        self.checkpoint_holds += 1
+        return self.rows_written
+
+    def rows_written(self, final=False):
+        if final:
+            self.checkpoint_holds -= 1
+        self.commit_checkpoints()
+
+    def commit_checkpoints(self):
+        """Commit the staged checkpoints unless a feed export only stores its rows at close."""
+        if not self.feeds_open:
+            self.report.commit_checkpoints()
+        elif self.feeds_incremental:
+            # Local feed files are written as items come in; flush what the exporters buffered first.
+            for extension in self.crawler.extensions.middlewares:
+                for slot in getattr(extension, 'slots', ()):
+                    if getattr(slot, 'file', None) is not None:
+                        slot.file.flush()
+            self.report.commit_checkpoints()
+
+    def feeds_stored(self):
+        self.feeds_open = False
+        if self.close_reason is not None:
+            self.close_report()
+
+    def closed(self, reason):
+        if self.report.profiler is not None:
+            self.report.profiler.dump()
+            logger.info(f'Profile of {self.report.profiler.pages} pages written to {self.report.profiler.path}')
+        self.close_reason = reason
+        # Feed exports may still be uploading; feeds_stored closes the report once they are done.
+        if not self.feeds_open:
+            self.close_report()
+
+    def close_report(self):
+        failed_feeds = any(key.startswith('feedexport/failed_count/') for key in self.crawler.stats.get_stats())
+        if not failed_feeds and not self.checkpoint_holds:
+            self.report.commit_checkpoints()
+        self.report.close(self.close_reason == 'finished')
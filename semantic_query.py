@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for building Power BI SemanticQuery fragments (Where conditions),
+splitting a query into independent shards and serializing querydata bodies.
+"""
+import copy
+import json
+from datetime import date, timedelta
+
+# SemanticQuery ComparisonKind values
+EQUAL = 0
+GREATER_THAN = 1
+GREATER_THAN_OR_EQUAL = 2
+LESS_THAN = 3
+LESS_THAN_OR_EQUAL = 4
+
+DEFAULT_SOURCE = 'n'
+
+
+def semantic_query(query):
+    """The ``SemanticQueryDataShapeCommand.Query`` dict of a querydata body."""
+    return query['queries'][0]['Query']['Commands'][0]['SemanticQueryDataShapeCommand']['Query']
+
+
+def data_reduction(query):
+    """The ``Binding.DataReduction`` dict of a querydata body."""
+    return query['queries'][0]['Query']['Commands'][0]['SemanticQueryDataShapeCommand']['Binding']['DataReduction']
+
+
+def window(query):
+    """The ``DataReduction.Primary.Window`` dict of a querydata body."""
+    return data_reduction(query)['Primary']['Window']
+
+
+def column(prop, source=DEFAULT_SOURCE):
+    return {"Column": {"Expression": {"SourceRef": {"Source": source}}, "Property": prop}}
+
+
+def literal(value):
+    """Encode a Python value as a SemanticQuery literal."""
+    if isinstance(value, bool):
+        return {"Literal": {"Value": 'true' if value else 'false'}}
+    if isinstance(value, int):
+        return {"Literal": {"Value": f'{value}L'}}
+    if isinstance(value, float):
+        return {"Literal": {"Value": f'{value!r}D'}}
+    if isinstance(value, date):
+        return {"Literal": {"Value": f"datetime'{value.isoformat()}T00:00:00'"}}
+    return {"Literal": {"Value": "'%s'" % str(value).replace("'", "''")}}
+
+
+def comparison(prop, kind, value, source=DEFAULT_SOURCE):
+    return {"Condition": {"Comparison": {"ComparisonKind": kind, "Left": column(prop, source),
+                                         "Right": literal(value)}}}
+
+
+def date_ranges(start, end, days):
+    """Split [start, end] into consecutive inclusive ranges of ``days`` days, newest first."""
+    ranges = []
+    upper = end
+    while upper >= start:
+        lower = max(start, upper - timedelta(days=days - 1))
+        ranges.append((lower, upper))
+        upper = lower - timedelta(days=1)
+    return ranges
+
+
+class QueryBuilder(object):
+    """Build querydata bodies from a query serialized once.
+
+    The constant part of ``query`` is rendered to JSON at construction with
+    placeholders for the Where clause, the restart token, the window size
+    and the DataVolume; :meth:`body` only splices per-request fragments into
+    it.  The query passed in is copied and never mutated, so any number of
+    RestartToken chains can be in flight at once.
+    """
+
+    _where_marker = '\x00where'
+    _restart_marker = '\x00restart'
+    _count_marker = '\x00count'
+    _volume_marker = '\x00volume'
+
+    def __init__(self, query):
+        query = copy.deepcopy(query)
+        target = semantic_query(query)
+        reduction = data_reduction(query)
+        self.conditions = target.pop('Where', [])
+        window(query).pop('RestartTokens', None)
+        self.count = window(query).get('Count')
+        self.data_volume = reduction.get('DataVolume')
+
+        # Where and RestartTokens are added last in their dicts, so each placeholder is preceded by a
+        # separator that is dropped together with it when the fragment is empty. Count and DataVolume
+        # keep their place and only their value is replaced.
+        target['Where'] = self._where_marker
+        window(query)['RestartTokens'] = self._restart_marker
+        placeholders = {
+            'where': ',"Where":' + json.dumps(self._where_marker),
+            'restart': ',"RestartTokens":' + json.dumps(self._restart_marker),
+        }
+        if self.count is not None:
+            window(query)['Count'] = self._count_marker
+            placeholders['count'] = json.dumps(self._count_marker)
+        if self.data_volume is not None:
+            reduction['DataVolume'] = self._volume_marker
+            placeholders['volume'] = json.dumps(self._volume_marker)
+        text = json.dumps(query, separators=(',', ':'))
+
+        parts, slots, position = [], [], 0
+        for index, slot, placeholder in sorted((text.index(p), slot, p) for slot, p in placeholders.items()):
+            parts.append(text[position:index])
+            slots.append(slot)
+            position = index + len(placeholder)
+        parts.append(text[position:])
+        self._parts = parts
+        self._slots = slots
+        self._no_where = self.where()
+
+    def where(self, conditions=()):
+        """Serialize the base Where conditions plus ``conditions`` into a splice-ready fragment."""
+        conditions = self.conditions + list(conditions)
+        if not conditions:
+            return ''
+        return ',"Where":' + json.dumps(conditions, separators=(',', ':'))
+
+    def body(self, where=None, restart_token=None, count=None, data_volume=None):
+        """The querydata body for a Where fragment (from :meth:`where`), restart token and window size.
+
+        ``count`` and ``data_volume`` default to the values of the query.
+        """
+        fragments = {
+            'where': self._no_where if where is None else where,
+            'restart': ',"RestartTokens":' + json.dumps(restart_token, separators=(',', ':'))
+            if restart_token is not None else '',
+            'count': str(int(count or self.count or 0)),
+            'volume': str(int(data_volume or self.data_volume or 0)),
+        }
+        parts = self._parts
+        pieces = [parts[0]]
+        for index, slot in enumerate(self._slots):
+            pieces.append(fragments[slot])
+            pieces.append(parts[index + 1])
+        return ''.join(pieces)